@@ -7,14 +7,31 @@ import os
 ARK_API_KEY = os.getenv("ARK_API_KEY", "")
 ARK_BASE_URL = os.getenv("ARK_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
 ARK_MODEL_NAME = os.getenv("ARK_MODEL_NAME", "doubao-seed-1-6-thinking-250715")
+# 开启后请求携带cache_control，让服务端缓存固定的系统提示词前缀（需模型服务支持）
+ARK_PROMPT_CACHE = os.getenv("ARK_PROMPT_CACHE", "").lower() in ("1", "true", "yes")
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "16"))  # 对话服务同时在途的LLM请求上限（被限流时自动下调）
+ARK_MAX_CONCURRENCY = int(os.getenv("ARK_MAX_CONCURRENCY", "16"))  # AI Agent节点同时在途的请求上限（所有工作流共享，被限流时自动下调）
+
+# 对话会话存储：配置REDIS_URL时使用Redis，否则保存在进程内存
+REDIS_URL = os.getenv("REDIS_URL", "")
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))  # 会话过期时间（秒）
 
 # 文件存储配置
 UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads")
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+SHEET_CACHE_DIR = os.path.join(DATA_DIR, "sheet_cache")  # Sheet的Parquet缓存文件
+
+# 上传限制
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(200 * 1024 * 1024)))  # 单个文件最大字节数
+UPLOAD_CHUNK_SIZE = 1 << 20  # 流式写盘的块大小（1MB）
+
+# 允许跨域访问的前端地址，多个用逗号分隔
+FRONTEND_ORIGINS = [o.strip() for o in os.getenv("FRONTEND_ORIGIN", "http://localhost:3000").split(",") if o.strip()]
 
 # 确保目录存在
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(SHEET_CACHE_DIR, exist_ok=True)
 
 # 数据库配置
 DATABASE_URL = f"sqlite:///{os.path.join(DATA_DIR, 'app.db')}"
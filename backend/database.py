@@ -2,56 +2,174 @@
 数据库初始化和操作
 """
 import aiosqlite
+import logging
 import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from aiosqlitepool import SQLiteConnectionPool
 from config import DATA_DIR
 
+logger = logging.getLogger(__name__)
+
 DATABASE_PATH = os.path.join(DATA_DIR, "app.db")
+DB_POOL_SIZE = 8
+# 表结构变更时递增，init_db据此决定是否执行建表/迁移
+SCHEMA_VERSION = 4
+
+# 每个新连接建立时执行的连接级PRAGMA（journal_mode为持久设置，在init_db中设置一次）
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",      # WAL下安全，提交时不再每次fsync
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",       # 64MB页缓存
+    "PRAGMA mmap_size=268435456",     # 256MB内存映射
+    "PRAGMA busy_timeout=5000",
+)
+
+# 全局连接池（在应用 lifespan 中创建/关闭）
+db_pool: Optional[SQLiteConnectionPool] = None
+
+
+async def _connect() -> aiosqlite.Connection:
+    """连接池的连接工厂"""
+    db = await aiosqlite.connect(DATABASE_PATH)
+    for pragma in CONNECTION_PRAGMAS:
+        await db.execute(pragma)
+    db.row_factory = aiosqlite.Row
+    return db
+
+
+async def _ensure_column(db: aiosqlite.Connection, table: str, column: str, decl: str):
+    """旧库缺少列时补充"""
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in await cursor.fetchall()}:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+async def _create_schema(db: aiosqlite.Connection):
+    """建表并迁移旧库（新增列、索引）"""
+    # 工作流表
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS workflows (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT,
+            config TEXT NOT NULL,
+            fingerprint TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # 旧库补充fingerprint列
+    await _ensure_column(db, "workflows", "fingerprint", "TEXT")
+    
+    # 执行历史表
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS execution_history (
+            id TEXT PRIMARY KEY,
+            workflow_id TEXT,
+            input_files TEXT,
+            output_file TEXT,
+            status TEXT,
+            result_summary TEXT,
+            node_details TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (workflow_id) REFERENCES workflows (id)
+        )
+    """)
+    # 旧库补充node_details列（每次执行一条记录，节点明细为JSON）
+    await _ensure_column(db, "execution_history", "node_details", "TEXT")
+    
+    # 上传文件记录表
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS uploaded_files (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            original_name TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            sheets TEXT,
+            content_hash TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await _ensure_column(db, "uploaded_files", "content_hash", "TEXT")
+    
+    # LLM响应缓存表（确定性调用）
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            content TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    
+    # 列表/历史查询按时间倒序，关联查询按workflow_id
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_files_created ON uploaded_files(created_at DESC)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_exec_created ON execution_history(created_at DESC)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_exec_workflow ON execution_history(workflow_id)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_wf_updated ON workflows(updated_at DESC)"
+    )
+    # 指纹仅用于新建时去重，不同工作流允许配置相同（旧库中的唯一索引先删除）
+    await db.execute("DROP INDEX IF EXISTS idx_wf_fingerprint")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_wf_fingerprint ON workflows(fingerprint)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_files_hash ON uploaded_files(content_hash)"
+    )
 
 
 async def init_db():
-    """初始化数据库表"""
+    """初始化数据库表（已是最新版本时跳过建表），并更新查询规划器的统计信息"""
     async with aiosqlite.connect(DATABASE_PATH) as db:
-        # 工作流表
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS workflows (
-                id TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                description TEXT,
-                config TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        # WAL模式：读写并发，读不阻塞写；写入数据库文件后持久生效。
+        # 切换需要独占访问，其他进程占用时跳过，下次启动再设置
+        try:
+            await db.execute("PRAGMA busy_timeout=5000")
+            await db.execute("PRAGMA journal_mode=WAL")
+        except aiosqlite.OperationalError as e:
+            logger.warning("切换WAL模式失败: %s", e)
         
-        # 执行历史表
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS execution_history (
-                id TEXT PRIMARY KEY,
-                workflow_id TEXT,
-                input_files TEXT,
-                output_file TEXT,
-                status TEXT,
-                result_summary TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (workflow_id) REFERENCES workflows (id)
-            )
-        """)
-        
-        # 上传文件记录表
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS uploaded_files (
-                id TEXT PRIMARY KEY,
-                filename TEXT NOT NULL,
-                original_name TEXT NOT NULL,
-                file_path TEXT NOT NULL,
-                sheets TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        cursor = await db.execute("PRAGMA user_version")
+        (version,) = await cursor.fetchone()
+        if version < SCHEMA_VERSION:
+            await _create_schema(db)
+            await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            await db.commit()
         
+        # 每次启动按实际数据更新统计信息，让查询规划器选用合适的索引；
+        # analysis_limit限制每个索引的采样行数，大库上也只需毫秒级
+        await db.execute("PRAGMA analysis_limit=1000")
+        await db.execute("ANALYZE")
         await db.commit()
 
 
-async def get_db():
-    """获取数据库连接"""
-    return aiosqlite.connect(DATABASE_PATH)
+async def init_pool() -> SQLiteConnectionPool:
+    """创建全局连接池，复用连接以保持SQLite页缓存常驻"""
+    global db_pool
+    if db_pool is None:
+        db_pool = SQLiteConnectionPool(_connect, pool_size=DB_POOL_SIZE)
+    return db_pool
+
+
+async def close_pool():
+    """关闭全局连接池"""
+    global db_pool
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+
+
+@asynccontextmanager
+async def get_connection() -> AsyncIterator[aiosqlite.Connection]:
+    """从连接池借出一个连接，使用完毕自动归还"""
+    if db_pool is None:
+        raise RuntimeError("数据库连接池未初始化")
+    async with db_pool.connection() as db:
+        yield db
@@ -1,35 +1,59 @@
 """
 FastAPI 应用入口
 """
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
 from routers import excel, workflow, ai
-from database import init_db
+from database import init_db, init_pool, close_pool
+from config import FRONTEND_ORIGINS
+from services.ai_service import ai_service
+from services.ai_chat_service import ai_chat_service
+from services.session_store import session_store
+from services.workflow_engine import workflow_engine, shutdown_process_pool
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     await init_db()
+    await init_pool()
+    # 有界线程池：Excel解析、文件读写等阻塞操作通过 asyncio.to_thread/aiofiles 在此执行，避免阻塞事件循环；
+    # 线程数与标准库默认一致（CPU数+4，最多32），核数少的机器上文件I/O不会排在解析任务之后
+    cpu_pool = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4), thread_name_prefix="cpu")
+    asyncio.get_running_loop().set_default_executor(cpu_pool)
+    app.state.cpu_pool = cpu_pool
     yield
+    await ai_service.aclose()
+    await ai_chat_service.aclose()
+    await workflow_engine.aclose()
+    await session_store.aclose()
+    await close_pool()
+    cpu_pool.shutdown(wait=False)
+    shutdown_process_pool()
 
 
 app = FastAPI(
     title="Excel工作流处理系统",
     description="支持自然语言描述的Excel财务核算工作流系统",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # 配置CORS
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=FRONTEND_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["content-type", "authorization", "range"],
+    max_age=86400,  # 预检结果由浏览器缓存24小时
 )
 
 # 注册路由
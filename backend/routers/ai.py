@@ -1,19 +1,29 @@
 """
 AI对话API - 将自然语言转换为工作流
 """
-import json
+import asyncio
 import logging
+import orjson
+from cachetools import TTLCache
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Dict, List, Any, Optional
 from services.ai_service import ai_service
 from services.ai_chat_service import ai_chat_service
 from services.excel_service import ExcelService
+from utils import fingerprint, singleflight
 
 router = APIRouter()
 excel_service = ExcelService()
 logger = logging.getLogger(__name__)
 
+# 工作流解释缓存：配置指纹 -> 解释文本
+_explain_cache: TTLCache = TTLCache(maxsize=256, ttl=3600)
+
+# 一次性生成缓存：(用户输入, 文件信息)指纹 -> 工作流配置
+_generate_cache: TTLCache = TTLCache(maxsize=512, ttl=300)
+
 
 class GenerateWorkflowRequest(BaseModel):
     """生成工作流请求"""
@@ -50,48 +60,55 @@ async def chat_start(request: ChatStartRequest):
     开始AI对话会话
     用户选择表后调用，AI会看到表结构
     """
-    logger.info(f"[AI-Chat] 开始对话，选择的文件: {request.selected_files}")
+    logger.info("[AI-Chat] 开始对话，选择的文件数: %d", len(request.selected_files))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[AI-Chat] 选择的文件: %s", request.selected_files)
     
     if not request.selected_files:
         raise HTTPException(status_code=400, detail="请至少选择一个数据表")
     
-    # 获取文件元数据（列名、样例数据）
+    # 并发获取文件元数据（列名、样例数据），同一文件只查一次
+    file_ids = list(dict.fromkeys(s.get("file_id") for s in request.selected_files))
+    records = await asyncio.gather(
+        *[excel_service.get_file_record(file_id) for file_id in file_ids],
+        return_exceptions=True
+    )
+    records_by_id = dict(zip(file_ids, records))
+    
     file_metadata = []
     for selection in request.selected_files:
         file_id = selection.get("file_id")
         sheet_name = selection.get("sheet_name")
+        file_record = records_by_id[file_id]
         
-        logger.debug(f"[AI-Chat] 获取文件元数据: file_id={file_id}, sheet={sheet_name}")
-        
-        try:
-            file_record = await excel_service.get_file_record(file_id)
-            if file_record:
-                sheets = file_record.get("sheets", "[]")
-                if isinstance(sheets, str):
-                    sheets = json.loads(sheets)
-                
-                # 找到指定sheet的信息
-                sheet_info = next((s for s in sheets if s.get("name") == sheet_name), None)
-                
-                if sheet_info:
-                    file_metadata.append({
-                        "file_id": file_id,
-                        "filename": file_record["original_name"],
-                        "sheet_name": sheet_name,
-                        "columns": sheet_info.get("columns", []),
-                        "row_count": sheet_info.get("row_count", 0),
-                        "sample_data": sheet_info.get("sample_data", [])[:3]
-                    })
-                    logger.debug(f"[AI-Chat] 获取成功: {file_record['original_name']}/{sheet_name}, {len(sheet_info.get('columns', []))}列")
-        except Exception as e:
-            logger.error(f"[AI-Chat] 获取文件元数据失败: {e}")
+        if isinstance(file_record, Exception):
+            logger.error("[AI-Chat] 获取文件元数据失败: %s", file_record)
+            continue
+        if file_record:
+            sheets = file_record["sheets"]
+            
+            # 找到指定sheet的信息
+            sheet_info = next((s for s in sheets if s.get("name") == sheet_name), None)
+            
+            if sheet_info:
+                file_metadata.append({
+                    "file_id": file_id,
+                    "filename": file_record["original_name"],
+                    "sheet_name": sheet_name,
+                    "columns": sheet_info.get("columns", []),
+                    "row_count": sheet_info.get("row_count", 0),
+                    "sample_data": sheet_info.get("preview", [])[:3]
+                })
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("[AI-Chat] 获取文件元数据成功: %s/%s, %d列",
+                                 file_record["original_name"], sheet_name, len(sheet_info.get("columns", [])))
     
     if not file_metadata:
         raise HTTPException(status_code=400, detail="无法获取所选表的信息")
     
     # 启动对话
-    result = ai_chat_service.start_session(request.selected_files, file_metadata)
-    logger.info(f"[AI-Chat] 对话已开始: session_id={result.get('session_id')}")
+    result = await ai_chat_service.start_session(request.selected_files, file_metadata)
+    logger.info("[AI-Chat] 对话已开始: session_id=%s", result.get("session_id"))
     
     return result
 
@@ -101,33 +118,58 @@ async def chat_message(request: ChatMessageRequest):
     """
     发送消息到AI对话
     """
-    logger.info(f"[AI-Chat] 收到消息: session={request.session_id}, msg={request.message[:50]}...")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[AI-Chat] 收到消息: session=%s, msg=%.50s", request.session_id, request.message)
     
     if not request.message.strip():
         raise HTTPException(status_code=400, detail="消息不能为空")
     
-    result = ai_chat_service.send_message(request.session_id, request.message)
+    # 重复提交的同一条消息共享一次AI调用
+    key = fingerprint([request.session_id, request.message])
+    result = await singleflight(
+        f"chat:{key}",
+        lambda: ai_chat_service.send_message(request.session_id, request.message)
+    )
     
     if result.get("status") == "error":
         raise HTTPException(status_code=400, detail=result.get("error", "发送失败"))
     
-    logger.info(f"[AI-Chat] AI回复状态: {result.get('status')}")
+    logger.debug("[AI-Chat] AI回复状态: %s", result.get("status"))
     return result
 
 
+@router.post("/chat/message/stream")
+async def chat_message_stream(request: ChatMessageRequest):
+    """
+    发送消息到AI对话（SSE流式返回回复）
+    """
+    if not request.message.strip():
+        raise HTTPException(status_code=400, detail="消息不能为空")
+    
+    async def event_stream():
+        async for event in ai_chat_service.stream_message(request.session_id, request.message):
+            yield b"data: " + orjson.dumps(event) + b"\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.post("/chat/generate")
 async def chat_generate(request: ChatGenerateRequest):
     """
     确认生成工作流
     """
-    logger.info(f"[AI-Chat] 确认生成: session={request.session_id}")
+    logger.info("[AI-Chat] 确认生成: session=%s", request.session_id)
     
-    result = ai_chat_service.generate_workflow(request.session_id)
+    result = await ai_chat_service.generate_workflow(request.session_id)
     
     if result.get("status") == "error":
         raise HTTPException(status_code=400, detail=result.get("error", "生成失败"))
     
-    logger.info(f"[AI-Chat] 工作流生成完成")
+    logger.info("[AI-Chat] 工作流生成完成")
     return result
 
 
@@ -140,7 +182,8 @@ async def generate_workflow(request: GenerateWorkflowRequest):
     """
     import traceback
     
-    logger.info(f"收到AI生成请求: user_input={request.user_input[:50]}..., file_ids={request.file_ids}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("收到AI生成请求: user_input=%.50s, file_ids=%s", request.user_input, request.file_ids)
     
     if not request.user_input.strip():
         raise HTTPException(status_code=400, detail="请输入处理描述")
@@ -148,38 +191,48 @@ async def generate_workflow(request: GenerateWorkflowRequest):
     # 获取文件信息
     files_info = []
     try:
-        for file_id in request.file_ids:
-            logger.info(f"正在获取文件信息: {file_id}")
-            file_record = await excel_service.get_file_record(file_id)
+        records = await asyncio.gather(
+            *[excel_service.get_file_record(file_id) for file_id in request.file_ids]
+        )
+        for file_id, file_record in zip(request.file_ids, records):
             if file_record:
-                sheets = file_record.get("sheets", "[]")
-                if isinstance(sheets, str):
-                    sheets = json.loads(sheets)
                 files_info.append({
                     "file_id": file_id,
                     "filename": file_record["original_name"],
-                    "sheets": sheets
+                    "sheets": file_record["sheets"]
                 })
-        logger.info(f"获取到 {len(files_info)} 个文件信息")
+        logger.debug("获取到 %d 个文件信息", len(files_info))
     except Exception as e:
-        logger.error(f"获取文件信息失败: {e}")
+        logger.error("获取文件信息失败: %s", e)
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"获取文件信息失败: {str(e)}")
     
-    try:
-        logger.info("开始调用AI服务...")
-        workflow_config = await ai_service.generate_workflow(
+    key = fingerprint([request.user_input, files_info])
+    
+    async def _generate() -> Dict[str, Any]:
+        cached = _generate_cache.get(key)
+        if cached is not None:
+            logger.debug("命中工作流生成缓存")
+            return cached
+        logger.debug("开始调用AI服务...")
+        config = await ai_service.generate_workflow(
             user_input=request.user_input,
             files_info=files_info
         )
-        logger.info(f"AI生成成功，节点数: {len(workflow_config.get('nodes', []))}")
+        _generate_cache[key] = config
+        logger.info("AI生成成功，节点数: %d", len(config.get("nodes", [])))
+        return config
+    
+    try:
+        # 同一请求并发到达时只调用一次AI
+        workflow_config = await singleflight(f"generate:{key}", _generate)
         
         return {
             "success": True,
             "workflow": workflow_config
         }
     except Exception as e:
-        logger.error(f"AI服务调用失败: {e}")
+        logger.error("AI服务调用失败: %s", e)
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"AI服务调用失败: {str(e)}")
 
@@ -189,8 +242,14 @@ async def explain_workflow(request: ExplainWorkflowRequest):
     """
     生成工作流的自然语言解释
     """
+    key = fingerprint(request.workflow_config)
+    cached = _explain_cache.get(key)
+    if cached is not None:
+        return {"explanation": cached}
+    
     try:
         explanation = await ai_service.explain_workflow(request.workflow_config)
+        _explain_cache[key] = explanation
         return {
             "explanation": explanation
         }
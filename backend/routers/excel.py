@@ -3,64 +3,154 @@ Excel文件上传和解析API
 """
 import os
 import uuid
-import json
+import hashlib
+import asyncio
+import aiofiles
 from fastapi import APIRouter, UploadFile, File, HTTPException
 from fastapi.responses import FileResponse
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 from services.excel_service import ExcelService
-from config import UPLOAD_DIR
+from config import UPLOAD_DIR, MAX_UPLOAD_SIZE, UPLOAD_CHUNK_SIZE
 
 router = APIRouter()
 excel_service = ExcelService()
 
+ALLOWED_EXTENSIONS = frozenset({".xlsx", ".xls", ".xlsm", ".xlsb", ".ods"})
+# 文件头签名：xlsx/xlsm/xlsb/ods 为zip容器，xls 为OLE2复合文档
+_MAGIC_SIGNATURES = (b"PK\x03\x04", b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1")
 
-@router.post("/upload")
-async def upload_excel(file: UploadFile = File(...)):
+
+async def _receive_upload(file: UploadFile) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
     """
-    上传Excel文件
+    校验、落盘并解析一个上传文件
     
     Returns:
-        {
-            "file_id": "xxx",
-            "filename": "原文件名.xlsx",
-            "sheets": [...]
-        }
+        (返回给前端的文件信息, 待写入数据库的记录；内容已存在时为None)
     """
-    # 验证文件类型
-    if not file.filename.endswith(('.xlsx', '.xls')):
-        raise HTTPException(status_code=400, detail="只支持Excel文件 (.xlsx, .xls)")
+    # 验证文件类型（扩展名不区分大小写）
+    if os.path.splitext(file.filename or "")[1].lower() not in ALLOWED_EXTENSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"只支持Excel文件 ({', '.join(sorted(ALLOWED_EXTENSIONS))})"
+        )
     
     # 生成唯一文件ID
-    file_id = str(uuid.uuid4())
-    saved_filename = f"{file_id}_{file.filename}"
+    file_id = uuid.uuid4().hex
+    saved_filename = f"{file_id}{os.path.splitext(file.filename)[1].lower()}"
     file_path = os.path.join(UPLOAD_DIR, saved_filename)
     
-    # 保存文件
-    content = await file.read()
-    with open(file_path, "wb") as f:
-        f.write(content)
+    # 先校验文件头，再落盘
+    chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    if not chunk.startswith(_MAGIC_SIGNATURES):
+        raise HTTPException(status_code=400, detail="文件内容不是有效的Excel格式")
+    
+    # 分块流式保存文件，避免整个文件驻留内存
+    written = 0
+    hasher = hashlib.blake2b()
+    try:
+        async with aiofiles.open(file_path, "wb") as f:
+            while chunk:
+                written += len(chunk)
+                if written > MAX_UPLOAD_SIZE:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"文件过大，最大支持 {MAX_UPLOAD_SIZE // (1024 * 1024)}MB"
+                    )
+                hasher.update(chunk)
+                await f.write(chunk)
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    except Exception:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    
+    # 相同内容已上传过：复用已有记录，不再重复解析和占用磁盘
+    content_hash = hasher.hexdigest()
+    existing = await excel_service.find_file_by_hash(content_hash)
+    if existing and os.path.exists(existing["file_path"]):
+        os.remove(file_path)
+        return {
+            "file_id": existing["id"],
+            "filename": existing["original_name"],
+            "sheets": existing["sheets"]
+        }, None
     
     # 解析Excel获取Sheet信息
     try:
-        parsed_info = excel_service.parse_excel(file_path)
+        parsed_info = await excel_service.parse_excel_async(file_path)
     except Exception as e:
         os.remove(file_path)
         raise HTTPException(status_code=400, detail=f"解析Excel失败: {str(e)}")
     
-    # 保存文件记录
-    await excel_service.save_file_record(
-        file_id=file_id,
-        filename=saved_filename,
-        original_name=file.filename,
-        file_path=file_path,
-        sheets=parsed_info["sheets"]
-    )
-    
+    record = {
+        "file_id": file_id,
+        "filename": saved_filename,
+        "original_name": file.filename,
+        "file_path": file_path,
+        "sheets": parsed_info["sheets"],
+        "content_hash": content_hash
+    }
     return {
         "file_id": file_id,
         "filename": file.filename,
         "sheets": parsed_info["sheets"]
-    }
+    }, record
+
+
+@router.post("/upload")
+async def upload_excel(file: UploadFile = File(...)):
+    """
+    上传Excel文件
+    
+    Returns:
+        {
+            "file_id": "xxx",
+            "filename": "原文件名.xlsx",
+            "sheets": [...]
+        }
+    """
+    result, record = await _receive_upload(file)
+    
+    # 保存文件记录
+    if record:
+        await excel_service.save_file_record(**record)
+    
+    return result
+
+
+@router.post("/upload/batch")
+async def upload_excel_batch(files: List[UploadFile] = File(...)):
+    """
+    批量上传Excel文件：并发落盘解析，文件记录一次性批量写入
+    
+    Returns:
+        {"files": [{"file_id", "filename", "sheets"} 或 {"filename", "error"}, ...]}
+    """
+    outcomes = await asyncio.gather(*[_receive_upload(f) for f in files], return_exceptions=True)
+    
+    results = []
+    records = []
+    by_hash: Dict[str, Dict[str, Any]] = {}
+    for file, outcome in zip(files, outcomes):
+        if isinstance(outcome, Exception):
+            detail = outcome.detail if isinstance(outcome, HTTPException) else str(outcome)
+            results.append({"filename": file.filename, "error": detail})
+            continue
+        
+        result, record = outcome
+        if record:
+            # 同一批次内内容重复的文件只保留第一份
+            first = by_hash.get(record["content_hash"])
+            if first:
+                os.remove(record["file_path"])
+                result = first
+            else:
+                by_hash[record["content_hash"]] = result
+                records.append(record)
+        results.append(result)
+    
+    await excel_service.save_file_records(records)
+    return {"files": results}
 
 
 @router.get("/files")
@@ -72,7 +162,7 @@ async def get_uploaded_files():
         result.append({
             "file_id": f["id"],
             "filename": f["original_name"],
-            "sheets": json.loads(f["sheets"]) if f["sheets"] else [],
+            "sheets": f["sheets"],
             "created_at": f["created_at"]
         })
     return {"files": result}
@@ -88,7 +178,7 @@ async def get_file_info(file_id: str):
     return {
         "file_id": file_record["id"],
         "filename": file_record["original_name"],
-        "sheets": json.loads(file_record["sheets"]) if file_record["sheets"] else [],
+        "sheets": file_record["sheets"],
         "created_at": file_record["created_at"]
     }
 
@@ -108,14 +198,9 @@ async def preview_sheet(file_id: str, sheet_name: str, rows: int = 10):
         raise HTTPException(status_code=404, detail="文件不存在")
     
     try:
-        df = excel_service.read_sheet_as_dataframe(file_record["file_path"], sheet_name)
-        preview_df = df.head(rows)
-        
-        return {
-            "columns": list(df.columns),
-            "data": preview_df.fillna("").to_dict(orient="records"),
-            "total_rows": len(df)
-        }
+        return await asyncio.to_thread(
+            excel_service.preview_sheet, file_record["file_path"], sheet_name, rows
+        )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"读取Sheet失败: {str(e)}")
 
@@ -127,7 +212,9 @@ async def delete_file(file_id: str):
     if not file_record:
         raise HTTPException(status_code=404, detail="文件不存在")
     
-    # 删除物理文件
+    # 删除物理文件及其Parquet缓存
+    # 内存中的Sheet缓存不持有文件句柄，且键含路径，已删除文件的条目不会再被命中，由LRU自然淘汰
+    excel_service.remove_sheet_cache_files(file_record["file_path"])
     if os.path.exists(file_record["file_path"]):
         os.remove(file_record["file_path"])
     
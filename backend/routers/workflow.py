@@ -2,20 +2,30 @@
 工作流管理API
 """
 import os
+import re
 import uuid
 import json
 from datetime import datetime
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import FileResponse
+from urllib.parse import quote
+import aiofiles
+from fastapi import APIRouter, HTTPException, Header
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 from services.workflow_engine import workflow_engine
 from services.excel_service import ExcelService
-from config import UPLOAD_DIR, DATA_DIR
+from config import UPLOAD_DIR, DATA_DIR, UPLOAD_CHUNK_SIZE
 
 router = APIRouter()
 excel_service = ExcelService()
 
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+_MEDIA_TYPES = {
+    ".csv": "text/csv",
+    ".parquet": "application/vnd.apache.parquet",
+}
+_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+
 
 class WorkflowSaveRequest(BaseModel):
     """保存工作流请求"""
@@ -28,18 +38,19 @@ class WorkflowExecuteRequest(BaseModel):
     """执行工作流请求"""
     workflow_config: Dict[str, Any]
     file_mapping: Dict[str, str]  # file_id -> file_id（用于查找实际路径）
+    workflow_id: Optional[str] = None  # 已保存的工作流ID，用于关联执行历史
 
 
 @router.post("/save")
 async def save_workflow(request: WorkflowSaveRequest):
     """保存工作流"""
-    workflow_id = str(uuid.uuid4())
-    
-    await workflow_engine.save_workflow(
-        workflow_id=workflow_id,
+    # 配置与已有工作流相同时复用其ID（名称和描述以本次提交为准）
+    workflow_id = await workflow_engine.save_workflow(
+        workflow_id=str(uuid.uuid4()),
         name=request.name,
         description=request.description,
-        config=request.config
+        config=request.config,
+        dedupe=True
     )
     
     return {
@@ -93,7 +104,8 @@ async def execute_workflow(request: WorkflowExecuteRequest):
         # 执行工作流 (使用新的引擎API)
         result = await workflow_engine.execute_workflow(
             request.workflow_config,
-            request.file_mapping
+            request.file_mapping,
+            workflow_id=request.workflow_id
         )
         
         if result.get("success"):
@@ -112,15 +124,77 @@ async def get_execution_history(limit: int = 50):
     return {"history": history}
 
 
+def _parse_range(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单段Range请求头，返回闭区间 (start, end)
+    
+    多段Range返回None，由调用方回退为完整下载；无法满足的范围抛出416。
+    """
+    match = _RANGE_RE.fullmatch(range_header.strip())
+    if not match:
+        return None
+    start_str, end_str = match.groups()
+    if start_str:
+        start = int(start_str)
+        end = min(int(end_str), file_size - 1) if end_str else file_size - 1
+    elif end_str:
+        # bytes=-N 表示最后N个字节
+        start = max(file_size - int(end_str), 0)
+        end = file_size - 1
+    else:
+        return None
+    if start > end or start >= file_size:
+        raise HTTPException(
+            status_code=416,
+            detail="请求的范围无效",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+    return start, end
+
+
+async def _iter_file_range(file_path: str, start: int, end: int):
+    """按块读取文件的指定范围"""
+    async with aiofiles.open(file_path, "rb") as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
 @router.get("/download/{filename}")
-async def download_result(filename: str):
-    """下载结果文件"""
+async def download_result(filename: str, range_header: Optional[str] = Header(None, alias="range")):
+    """下载结果文件（支持Range断点续传）"""
     file_path = os.path.join(UPLOAD_DIR, filename)
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="文件不存在")
     
+    stat_result = os.stat(file_path)
+    media_type = _MEDIA_TYPES.get(os.path.splitext(filename)[1].lower(), XLSX_MEDIA_TYPE)
+    byte_range = _parse_range(range_header, stat_result.st_size) if range_header else None
+    
+    if byte_range:
+        start, end = byte_range
+        return StreamingResponse(
+            _iter_file_range(file_path, start, end),
+            status_code=206,
+            media_type=media_type,
+            headers={
+                "Accept-Ranges": "bytes",
+                "Content-Range": f"bytes {start}-{end}/{stat_result.st_size}",
+                "Content-Length": str(end - start + 1),
+                "Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}"
+            }
+        )
+    
+    # 传入stat_result，避免重复stat并直接给出Content-Length
     return FileResponse(
         path=file_path,
         filename=filename,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        media_type=media_type,
+        stat_result=stat_result,
+        headers={"Accept-Ranges": "bytes"}
     )
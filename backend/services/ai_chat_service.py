@@ -2,19 +2,185 @@
 AI Chat Service - 交互式工作流生成器
 支持多轮对话，先选表再对话模式
 """
+import functools
 import logging
-import uuid
-from typing import Dict, List, Optional
+import os
+import re
+import secrets
+from typing import AsyncIterator, List, Optional
 from datetime import datetime
-from openai import OpenAI
-from config import ARK_API_KEY, ARK_BASE_URL, ARK_MODEL_NAME
+import httpx
+from openai import AsyncOpenAI, RateLimitError
+from config import ARK_API_KEY, ARK_BASE_URL, ARK_MODEL_NAME, ARK_PROMPT_CACHE, CHAT_MAX_CONCURRENCY
+from services.session_store import session_store
+from services import llm_cache
+from utils import AdaptiveLimiter, extract_json
 
 # 配置日志
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 
-# 会话存储 (生产环境应使用Redis)
-chat_sessions: Dict[str, dict] = {}
+HISTORY_KEEP_TURNS = 8         # 保留最近的对话轮数（每轮一问一答）
+HISTORY_CHAR_BUDGET = 12000    # 历史消息字符数上限（中文约1字符≈1token）
+SUMMARY_PREFIX = "此前对话摘要："
+# 固定温度0：输出稳定，且相同的前缀更容易命中服务端提示词缓存
+CHAT_TEMPERATURE = 0
+# 提示词缓存的额外请求参数（未开启时为None）
+_CACHE_EXTRA_BODY = {"cache_control": {"type": "ephemeral"}} if ARK_PROMPT_CACHE else None
+RATE_LIMIT_LOW_WATER = 5       # 剩余请求配额低于该值时主动降低并发
+
+
+def _retry_after(headers) -> Optional[float]:
+    """解析retry-after响应头（秒）"""
+    try:
+        return float(headers.get("retry-after", ""))
+    except (TypeError, ValueError):
+        return None
+
+# 确认触发词 - 当AI理解需求后会触发确认；编译为一个正则，单次扫描回复
+CONFIRM_KEYWORDS = (
+    "确认生成", "开始生成", "是否确认", "确定生成",
+    "生成工作流", "开始构建", "帮您生成", "立即生成",
+    "可以生成", "需要确认", "是否开始", "是否生成",
+    "方案如下", "以下步骤", "处理步骤", "工作流方案",
+    "帮您处理", "开始处理", "如您确认", "确认后",
+    "请确认", "好的", "明白", "了解", "没问题", "可以"
+)
+_CONFIRM_RE = re.compile("|".join(map(re.escape, CONFIRM_KEYWORDS)))
+
+
+def _tables_key(file_metadata: List[dict]) -> tuple:
+    """将文件元数据转为可哈希的键，供提示词缓存使用"""
+    return tuple(
+        (
+            meta.get("filename"),
+            meta.get("sheet_name", "Sheet1"),
+            meta.get("row_count", 0),
+            tuple(meta.get("columns", [])),
+            str(meta.get("sample_data", [])[:3])
+        )
+        for meta in file_metadata
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _build_tables_context(tables: tuple, focus_index: Optional[int] = None) -> str:
+    """构建表结构上下文，仅focus_index指定的表附带样例数据"""
+    context_parts = []
+    
+    for i, (filename, sheet_name, row_count, columns, sample_data) in enumerate(tables, 1):
+        part = f"""表{i}: {filename or f'表{i}'} / {sheet_name}
+  - 行数: {row_count}
+  - 列名: {', '.join(columns[:15])}{'...' if len(columns) > 15 else ''}"""
+        if focus_index == i - 1:
+            part += f"\n  - 样例数据: {sample_data}"
+        
+        context_parts.append(part)
+    
+    return "\n\n".join(context_parts)
+
+
+@functools.lru_cache(maxsize=256)
+def _build_system_prompt(tables_context: str) -> str:
+    """构建系统提示词（相同表结构得到逐字节相同的前缀，便于服务端提示词缓存）"""
+    return f"""你是ExcelFlow工作流设计专家。你的任务是帮助用户设计数据处理工作流。
+
+========== 用户选择的数据表 ==========
+{tables_context}
+
+========== 你的思考流程（必须严格遵循） ==========
+
+【第一步：深度分析表结构】
+1. 逐个阅读每张表的列名，理解每列的业务含义
+2. 标记关键字段：
+   - 唯一标识字段（如：订单号、用户ID）
+   - 维度字段（如：市场id、门店id、类别）
+   - 度量字段（如：金额、数量）
+   - 日期字段
+3. 识别表间关系：
+   - 哪些列可以作为关联键连接不同表？
+   - 有没有表缺少某些字段，需要从其他表查找补全？
+4. 向用户确认你的理解是否正确
+
+【第二步：拆解用户需求】
+将复杂需求分解为清晰的子任务，例如：
+- "业绩核对" = 签收核对 + 退货核对 + 差异汇总
+- "数据清洗" = 去重 + 填充空值 + 格式统一
+- "报表生成" = 筛选 + 分组汇总 + 排序
+每个子任务对应1-2个节点
+
+【第三步：设计数据流】
+思考数据从源头到输出的流向：
+1. 源表读取（source节点）
+2. 数据补全（vlookup节点，如果需要）
+3. 数据清洗（transform/fill_na/deduplicate）
+4. 分组汇总（group_aggregate）
+5. 多表关联或对比（join/reconcile）
+6. 结果输出（output节点）
+
+【第四步：选择正确的节点】
+
+=== 数据源节点 ===
+• source: 读取Excel文件的一个Sheet
+• source_csv: 读取CSV文件
+
+=== 数据清洗节点 ===
+• transform: 万能清洗节点
+  - filter_code: 筛选行（如 "金额 > 0"）
+  - calculations: 计算新列（如 目标列 = 列A - 列B）
+  - selected_columns: 只保留指定列
+  - rename_map: 列重命名
+  - sort_by: 排序
+• type_convert: 转换数据类型（文本→数字、日期）
+• fill_na: 处理缺失值（删除/填充/均值）
+• deduplicate: 去重
+• text_process: 文本处理（去空格、大小写、替换）
+• date_process: 日期处理（提取年月日、日期偏移）
+
+=== 数据分析节点 ===
+• group_aggregate: 分组汇总（核心节点！）
+  - group_by: 分组维度
+  - aggregations: 对哪列做什么聚合（sum/count/mean/min/max）
+• pivot: 透视表（行列转换）
+• unpivot: 逆透视（列转行）
+
+=== 多表操作节点（重点区分！）===
+• vlookup: 查找补列（主表保持不变，从查找表获取指定列）
+  用途：表A缺某字段，从表B查找补全
+  配置：left_key(主表列), right_key(查找表列), columns_to_get(获取的列)
+  
+• join: 合并两表（返回两表所有列的交集/并集）
+  用途：需要两表的全部信息
+  配置：how(inner/left/right/outer), left_on, right_on
+  
+• concat: 纵向堆叠（相同结构的表上下拼接）
+  用途：合并多个相同格式的表
+  
+• diff: 差异对比（找出两表不同的行）
+
+• reconcile: 对账核算（最适合财务核对！）
+  用途：明细表汇总后与汇总表对比，找差异
+  配置：join_keys(关联维度), left_column(明细金额), right_column(汇总金额)
+  工作原理：自动将明细表按join_keys汇总，与汇总表对比，输出差异
+
+=== 自动化节点 ===
+• code: 自定义Python代码（复杂逻辑时使用）
+
+=== 输出节点 ===
+• output: 输出Excel文件
+• output_csv: 输出CSV文件
+
+【第五步：验证设计】
+- 所有列名是否都来自实际表结构？禁止臆造列名！
+- 节点连接顺序是否正确？（源头→处理→输出）
+- 能否完整解决用户的全部需求？
+
+========== 对话规则 ==========
+1. 分析完表结构后，向用户确认你的理解
+2. 向用户询问关键信息（关联键是什么？按什么维度汇总？对比哪些金额？）
+3. 用列表清晰展示你的设计方案
+4. 确认需求后询问"是否确认生成工作流？"
+5. 对话阶段绝不输出JSON，JSON只在生成步骤输出
+6. JSON必须是标准格式，禁止包含任何注释"""
 
 
 class AIChatService:
@@ -22,10 +188,79 @@ class AIChatService:
     
     def __init__(self):
         logger.info("[AIChatService] 初始化AI对话服务")
-        self.client = OpenAI(api_key=ARK_API_KEY, base_url=ARK_BASE_URL)
+        self.client = AsyncOpenAI(
+            api_key=ARK_API_KEY,
+            base_url=ARK_BASE_URL,
+            http_client=httpx.AsyncClient(http2=True, timeout=120.0)  # HTTP/2多路复用，多会话共用连接
+        )
         self.model = ARK_MODEL_NAME
+        # 限制同时在途的LLM请求数，并根据上游限流信号自适应调整（AIMD）
+        self._limiter = AdaptiveLimiter(CHAT_MAX_CONCURRENCY)
+    
+    async def _complete(self, messages: List[dict], temperature: float) -> str:
+        """调用对话补全接口，返回回复文本（temperature=0的调用走响应缓存）"""
+        key = None
+        if temperature == 0:
+            key = llm_cache.cache_key(self.model, temperature, messages)
+            try:
+                cached = await llm_cache.get_cached(key)
+            except Exception as e:
+                logger.warning("[AIChatService] 读取响应缓存失败: %s", e)
+                cached = None
+            if cached is not None:
+                logger.debug("[AIChatService] 命中响应缓存")
+                return cached
         
-    def start_session(self, selected_files: List[dict], file_metadata: List[dict]) -> dict:
+        async with self._limiter:
+            try:
+                raw = await self.client.chat.completions.with_raw_response.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=temperature,
+                    extra_body=_CACHE_EXTRA_BODY
+                )
+            except RateLimitError as e:
+                self._limiter.on_throttle(_retry_after(e.response.headers))
+                raise
+            self._observe_rate_limit(raw.headers)
+        response = raw.parse()
+        self._log_usage(response.usage)
+        content = response.choices[0].message.content
+        if key is not None and content:
+            try:
+                await llm_cache.set_cached(key, content)
+            except Exception as e:
+                logger.warning("[AIChatService] 写入响应缓存失败: %s", e)
+        return content
+    
+    def _observe_rate_limit(self, headers):
+        """根据响应头中的剩余配额调整并发上限"""
+        remaining = headers.get("x-ratelimit-remaining-requests") or headers.get("x-ratelimit-remaining")
+        try:
+            low = remaining is not None and int(remaining) < RATE_LIMIT_LOW_WATER
+        except ValueError:
+            low = False
+        if low:
+            logger.warning("[AIChatService] 上游剩余请求配额不足(%s)，降低并发", remaining)
+            self._limiter.on_throttle(_retry_after(headers))
+        else:
+            self._limiter.on_success()
+    
+    @staticmethod
+    def _log_usage(usage):
+        """记录token用量，含命中提示词缓存的输入token数"""
+        if usage is None or not logger.isEnabledFor(logging.DEBUG):
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) or 0
+        logger.debug("[AIChatService] token用量: 输入=%s (缓存命中=%s), 输出=%s",
+                     usage.prompt_tokens, cached, usage.completion_tokens)
+    
+    async def aclose(self):
+        """关闭底层HTTP连接（应用关闭时调用）"""
+        await self.client.close()
+        
+    async def start_session(self, selected_files: List[dict], file_metadata: List[dict]) -> dict:
         """
         开始新的对话会话
         
@@ -36,40 +271,40 @@ class AIChatService:
         Returns:
             {"session_id": "xxx", "message": "AI开场白", "status": "clarifying"}
         """
-        session_id = str(uuid.uuid4())[:8]
-        logger.info(f"[AIChatService] 开始新会话: session_id={session_id}")
-        logger.debug(f"[AIChatService] 选择的文件: {selected_files}")
-        logger.debug(f"[AIChatService] 文件元数据: {file_metadata}")
+        # 会话ID即访问凭证，直接取系统随机数（不做uuid格式化再截断）
+        session_id = secrets.token_hex(8)
+        logger.info("[AIChatService] 开始新会话: session_id=%s", session_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[AIChatService] 选择的文件: %s", selected_files)
+            logger.debug("[AIChatService] 文件元数据: %s", file_metadata)
         
         # 构建表结构上下文
-        tables_context = self._build_tables_context(file_metadata)
-        logger.debug(f"[AIChatService] 表结构上下文:\n{tables_context}")
+        tables_context = _build_tables_context(_tables_key(file_metadata))
+        logger.debug("[AIChatService] 表结构上下文:\n%s", tables_context)
         
         # 系统提示词
-        system_prompt = self._build_system_prompt(tables_context)
+        system_prompt = _build_system_prompt(tables_context)
+        
+        # 生成AI开场白
+        opening_message = self._generate_opening(session_id, file_metadata)
+        logger.debug("[AIChatService] AI开场白: %.100s", opening_message)
         
-        # 初始化会话
-        chat_sessions[session_id] = {
+        # 初始化会话（完整元数据保存在服务端，提示词里只放列名）
+        # 系统提示词和开场白一次性构造，不再逐条append
+        session = {
             "created_at": datetime.now().isoformat(),
             "selected_files": selected_files,
             "file_metadata": file_metadata,
             "tables_context": tables_context,
+            "focus_table": None,
             "messages": [
-                {"role": "system", "content": system_prompt}
+                {"role": "system", "content": system_prompt},
+                {"role": "assistant", "content": opening_message}
             ],
             "status": "clarifying",  # clarifying / confirmed / generated
             "extracted_requirements": None
         }
-        
-        # 生成AI开场白
-        opening_message = self._generate_opening(session_id, file_metadata)
-        logger.info(f"[AIChatService] AI开场白: {opening_message[:100]}...")
-        
-        # 保存AI消息
-        chat_sessions[session_id]["messages"].append({
-            "role": "assistant",
-            "content": opening_message
-        })
+        await session_store.set(session_id, session)
         
         return {
             "session_id": session_id,
@@ -77,7 +312,7 @@ class AIChatService:
             "status": "clarifying"
         }
     
-    def send_message(self, session_id: str, user_message: str) -> dict:
+    async def send_message(self, session_id: str, user_message: str) -> dict:
         """
         发送用户消息，获取AI回复
         
@@ -88,54 +323,109 @@ class AIChatService:
         Returns:
             {"message": "AI回复", "status": "clarifying/confirmed", "requirements": {...}}
         """
-        logger.info(f"[AIChatService] 收到用户消息: session={session_id}, msg={user_message[:50]}...")
+        logger.debug("[AIChatService] 收到用户消息: session=%s, msg=%.50s", session_id, user_message)
         
-        if session_id not in chat_sessions:
-            logger.error(f"[AIChatService] 会话不存在: {session_id}")
+        session = await session_store.get(session_id)
+        if session is None:
+            logger.error("[AIChatService] 会话不存在: %s", session_id)
             return {"error": "会话不存在或已过期", "status": "error"}
         
-        session = chat_sessions[session_id]
-        
-        # 添加用户消息
-        session["messages"].append({
-            "role": "user",
-            "content": user_message
-        })
+        self._begin_turn(session, user_message)
         
         # 调用AI
         try:
-            logger.debug(f"[AIChatService] 调用AI，消息数: {len(session['messages'])}")
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=session["messages"],
-                temperature=0.7
-            )
-            
-            ai_reply = response.choices[0].message.content
-            logger.info(f"[AIChatService] AI回复: {ai_reply[:100]}...")
-            
-            # 保存AI回复
-            session["messages"].append({
-                "role": "assistant",
-                "content": ai_reply
-            })
+            logger.debug("[AIChatService] 调用AI，消息数: %d", len(session["messages"]))
             
-            # 分析AI回复，判断是否已确认需求
-            status = self._analyze_reply_status(ai_reply)
-            session["status"] = status
-            logger.debug(f"[AIChatService] 当前状态: {status}")
+            ai_reply = await self._complete(session["messages"], temperature=CHAT_TEMPERATURE)
+            logger.debug("[AIChatService] AI回复: %.100s", ai_reply)
             
+            status = await self._end_turn(session, ai_reply)
             return {
                 "message": ai_reply,
                 "status": status
             }
             
         except Exception as e:
-            logger.error(f"[AIChatService] AI调用失败: {e}")
+            logger.error("[AIChatService] AI调用失败: %s", e)
             return {"error": str(e), "status": "error"}
+        finally:
+            await session_store.set(session_id, session)
+    
+    async def stream_message(self, session_id: str, user_message: str) -> AsyncIterator[dict]:
+        """
+        流式发送用户消息，逐段产出AI回复
+        
+        Yields:
+            {"delta": "片段"} ...，最后一条为 {"done": True, "message": "完整回复", "status": "..."}
+            或 {"error": "...", "status": "error"}
+        """
+        session = await session_store.get(session_id)
+        if session is None:
+            logger.error("[AIChatService] 会话不存在: %s", session_id)
+            yield {"error": "会话不存在或已过期", "status": "error"}
+            return
+        
+        self._begin_turn(session, user_message)
+        
+        try:
+            parts = []
+            async with self._limiter:
+                try:
+                    stream = await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=session["messages"],
+                        temperature=CHAT_TEMPERATURE,
+                        extra_body=_CACHE_EXTRA_BODY,
+                        stream=True
+                    )
+                except RateLimitError as e:
+                    self._limiter.on_throttle(_retry_after(e.response.headers))
+                    raise
+                self._observe_rate_limit(stream.response.headers)
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        parts.append(delta)
+                        yield {"delta": delta}
+            
+            ai_reply = "".join(parts)
+            status = await self._end_turn(session, ai_reply)
+            yield {"done": True, "message": ai_reply, "status": status}
+            
+        except Exception as e:
+            logger.error("[AIChatService] AI流式调用失败: %s", e)
+            yield {"error": str(e), "status": "error"}
+        finally:
+            await session_store.set(session_id, session)
     
-    def generate_workflow(self, session_id: str) -> dict:
+    def _begin_turn(self, session: dict, user_message: str):
+        """记录用户消息（首条消息时先聚焦相关表）"""
+        # 首条消息：挑出最相关的表，只为该表补充样例数据
+        if session["focus_table"] is None:
+            self._focus_relevant_table(session, user_message)
+        
+        session["messages"].append({
+            "role": "user",
+            "content": user_message
+        })
+    
+    async def _end_turn(self, session: dict, ai_reply: str) -> str:
+        """保存AI回复并更新会话状态，返回新状态"""
+        session["messages"].append({
+            "role": "assistant",
+            "content": ai_reply
+        })
+        
+        # 历史过长时把较早的轮次压缩成摘要
+        await self._compact_history(session)
+        
+        # 分析AI回复，判断是否已确认需求
+        status = self._analyze_reply_status(ai_reply)
+        session["status"] = status
+        logger.debug("[AIChatService] 当前状态: %s", status)
+        return status
+    
+    async def generate_workflow(self, session_id: str) -> dict:
         """
         根据对话生成工作流
         
@@ -145,14 +435,13 @@ class AIChatService:
         Returns:
             {"workflow": {...}, "status": "generated"}
         """
-        logger.info(f"[AIChatService] 生成工作流: session={session_id}")
+        logger.info("[AIChatService] 生成工作流: session=%s", session_id)
         
-        if session_id not in chat_sessions:
-            logger.error(f"[AIChatService] 会话不存在: {session_id}")
+        session = await session_store.get(session_id)
+        if session is None:
+            logger.error("[AIChatService] 会话不存在: %s", session_id)
             return {"error": "会话不存在", "status": "error"}
         
-        session = chat_sessions[session_id]
-        
         # 构建文件信息映射，供AI使用真实的file_id和列名
         file_info_lines = []
         for i, meta in enumerate(session.get("file_metadata", []), 1):
@@ -309,26 +598,18 @@ output_csv: {{"filename": "结果.csv", "encoding": "utf-8"}}
         })
         
         try:
-            logger.debug(f"[AIChatService] 请求生成工作流...")
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=session["messages"],
-                temperature=0.3
-            )
-            
-            ai_reply = response.choices[0].message.content
-            logger.debug(f"[AIChatService] 生成结果: {ai_reply[:200]}...")
+            logger.debug("[AIChatService] 请求生成工作流...")
             
-            # 解析JSON
-            import json
-            import re
+            ai_reply = await self._complete(session["messages"], temperature=CHAT_TEMPERATURE)
+            logger.debug("[AIChatService] 生成结果: %.200s", ai_reply)
             
             # 提取JSON部分
-            json_match = re.search(r'\{[\s\S]*\}', ai_reply)
-            if json_match:
-                workflow = json.loads(json_match.group())
-                logger.info(f"[AIChatService] 工作流生成成功: {len(workflow.get('nodes', []))} 个节点")
+            try:
+                workflow = extract_json(ai_reply)
+            except ValueError:
+                workflow = None
+            if isinstance(workflow, dict):
+                logger.info("[AIChatService] 工作流生成成功: %d 个节点", len(workflow.get("nodes", [])))
                 
                 # 【关键修复】将生成的JSON保存到对话历史，供后续修改使用
                 session["messages"].append({
@@ -343,134 +624,68 @@ output_csv: {{"filename": "结果.csv", "encoding": "utf-8"}}
                     "status": "generated"
                 }
             else:
-                logger.error(f"[AIChatService] 无法解析工作流JSON")
+                logger.error("[AIChatService] 无法解析工作流JSON")
                 return {"error": "生成的工作流格式错误", "status": "error"}
                 
         except Exception as e:
-            logger.error(f"[AIChatService] 生成工作流失败: {e}")
+            logger.error("[AIChatService] 生成工作流失败: %s", e)
             return {"error": str(e), "status": "error"}
+        finally:
+            await session_store.set(session_id, session)
     
-    def _build_tables_context(self, file_metadata: List[dict]) -> str:
-        """构建表结构上下文"""
-        context_parts = []
+    async def _compact_history(self, session: dict):
+        """保留系统提示词和最近K轮对话，更早的消息合并为一条摘要"""
+        messages = session["messages"]
+        keep = 2 * HISTORY_KEEP_TURNS
+        history = messages[1:]
+        if len(history) <= keep and sum(len(m["content"]) for m in history) <= HISTORY_CHAR_BUDGET:
+            return
         
-        for i, meta in enumerate(file_metadata, 1):
-            filename = meta.get("filename", f"表{i}")
-            sheet_name = meta.get("sheet_name", "Sheet1")
-            columns = meta.get("columns", [])
-            sample_data = meta.get("sample_data", [])
-            row_count = meta.get("row_count", 0)
-            
-            part = f"""表{i}: {filename} / {sheet_name}
-  - 行数: {row_count}
-  - 列名: {', '.join(columns[:15])}{'...' if len(columns) > 15 else ''}
-  - 样例数据: {sample_data[:3]}"""
-            
-            context_parts.append(part)
+        older = history[:-keep] if len(history) > keep else history[:-2]
+        if not older:
+            return
         
-        return "\n\n".join(context_parts)
+        transcript = "\n".join(
+            m["content"] if m["role"] == "system" else f"{'用户' if m['role'] == 'user' else '助手'}: {m['content']}"
+            for m in older
+        )
+        try:
+            summary = await self._complete([
+                {"role": "system", "content": "你负责压缩对话历史。"},
+                {"role": "user", "content": f"请用简洁的中文总结以下对话中用户的需求、确认过的字段和设计决定，不超过300字：\n\n{transcript}"}
+            ], temperature=0.3)
+        except Exception as e:
+            logger.warning("[AIChatService] 压缩对话历史失败: %s", e)
+            return
+        
+        session["messages"] = [
+            messages[0],
+            {"role": "system", "content": f"{SUMMARY_PREFIX}{summary}"},
+            *history[len(older):]
+        ]
+        logger.debug("[AIChatService] 已压缩对话历史: %d 条 -> 1 条摘要", len(older))
     
-    def _build_system_prompt(self, tables_context: str) -> str:
-        """构建系统提示词"""
-        return f"""你是ExcelFlow工作流设计专家。你的任务是帮助用户设计数据处理工作流。
-
-========== 用户选择的数据表 ==========
-{tables_context}
-
-========== 你的思考流程（必须严格遵循） ==========
-
-【第一步：深度分析表结构】
-1. 逐个阅读每张表的列名，理解每列的业务含义
-2. 标记关键字段：
-   - 唯一标识字段（如：订单号、用户ID）
-   - 维度字段（如：市场id、门店id、类别）
-   - 度量字段（如：金额、数量）
-   - 日期字段
-3. 识别表间关系：
-   - 哪些列可以作为关联键连接不同表？
-   - 有没有表缺少某些字段，需要从其他表查找补全？
-4. 向用户确认你的理解是否正确
-
-【第二步：拆解用户需求】
-将复杂需求分解为清晰的子任务，例如：
-- "业绩核对" = 签收核对 + 退货核对 + 差异汇总
-- "数据清洗" = 去重 + 填充空值 + 格式统一
-- "报表生成" = 筛选 + 分组汇总 + 排序
-每个子任务对应1-2个节点
-
-【第三步：设计数据流】
-思考数据从源头到输出的流向：
-1. 源表读取（source节点）
-2. 数据补全（vlookup节点，如果需要）
-3. 数据清洗（transform/fill_na/deduplicate）
-4. 分组汇总（group_aggregate）
-5. 多表关联或对比（join/reconcile）
-6. 结果输出（output节点）
-
-【第四步：选择正确的节点】
-
-=== 数据源节点 ===
-• source: 读取Excel文件的一个Sheet
-• source_csv: 读取CSV文件
-
-=== 数据清洗节点 ===
-• transform: 万能清洗节点
-  - filter_code: 筛选行（如 "金额 > 0"）
-  - calculations: 计算新列（如 目标列 = 列A - 列B）
-  - selected_columns: 只保留指定列
-  - rename_map: 列重命名
-  - sort_by: 排序
-• type_convert: 转换数据类型（文本→数字、日期）
-• fill_na: 处理缺失值（删除/填充/均值）
-• deduplicate: 去重
-• text_process: 文本处理（去空格、大小写、替换）
-• date_process: 日期处理（提取年月日、日期偏移）
-
-=== 数据分析节点 ===
-• group_aggregate: 分组汇总（核心节点！）
-  - group_by: 分组维度
-  - aggregations: 对哪列做什么聚合（sum/count/mean/min/max）
-• pivot: 透视表（行列转换）
-• unpivot: 逆透视（列转行）
-
-=== 多表操作节点（重点区分！）===
-• vlookup: 查找补列（主表保持不变，从查找表获取指定列）
-  用途：表A缺某字段，从表B查找补全
-  配置：left_key(主表列), right_key(查找表列), columns_to_get(获取的列)
-  
-• join: 合并两表（返回两表所有列的交集/并集）
-  用途：需要两表的全部信息
-  配置：how(inner/left/right/outer), left_on, right_on
-  
-• concat: 纵向堆叠（相同结构的表上下拼接）
-  用途：合并多个相同格式的表
-  
-• diff: 差异对比（找出两表不同的行）
-
-• reconcile: 对账核算（最适合财务核对！）
-  用途：明细表汇总后与汇总表对比，找差异
-  配置：join_keys(关联维度), left_column(明细金额), right_column(汇总金额)
-  工作原理：自动将明细表按join_keys汇总，与汇总表对比，输出差异
-
-=== 自动化节点 ===
-• code: 自定义Python代码（复杂逻辑时使用）
-
-=== 输出节点 ===
-• output: 输出Excel文件
-• output_csv: 输出CSV文件
-
-【第五步：验证设计】
-- 所有列名是否都来自实际表结构？禁止臆造列名！
-- 节点连接顺序是否正确？（源头→处理→输出）
-- 能否完整解决用户的全部需求？
-
-========== 对话规则 ==========
-1. 分析完表结构后，向用户确认你的理解
-2. 向用户询问关键信息（关联键是什么？按什么维度汇总？对比哪些金额？）
-3. 用列表清晰展示你的设计方案
-4. 确认需求后询问"是否确认生成工作流？"
-5. 对话阶段绝不输出JSON，JSON只在生成步骤输出
-6. JSON必须是标准格式，禁止包含任何注释"""
+    def _focus_relevant_table(self, session: dict, user_message: str):
+        """按用户消息与表名/列名的子串匹配打分，将得分最高的表的样例数据补进系统提示词"""
+        file_metadata = session["file_metadata"]
+        scores = []
+        for meta in file_metadata:
+            score = sum(1 for col in meta.get("columns", []) if col and str(col) in user_message)
+            for name in (meta.get("sheet_name"), os.path.splitext(meta.get("filename", ""))[0]):
+                if name and name in user_message:
+                    score += 2
+            scores.append(score)
+        
+        best = max(range(len(scores)), key=scores.__getitem__)
+        if scores[best] == 0 and len(file_metadata) > 1:
+            # 无法判断相关表时保持精简提示词
+            session["focus_table"] = -1
+            return
+        
+        session["focus_table"] = best
+        session["tables_context"] = _build_tables_context(_tables_key(file_metadata), best)
+        session["messages"][0]["content"] = _build_system_prompt(session["tables_context"])
+        logger.debug("[AIChatService] 聚焦表: %d, 得分: %d", best + 1, scores[best])
     
     def _generate_opening(self, session_id: str, file_metadata: List[dict]) -> str:
         """生成AI开场白"""
@@ -491,21 +706,7 @@ output_csv: {{"filename": "结果.csv", "encoding": "utf-8"}}
     
     def _analyze_reply_status(self, ai_reply: str) -> str:
         """分析AI回复，判断需求状态"""
-        # 扩展触发词列表 - 当AI理解需求后会触发确认
-        confirm_keywords = [
-            "确认生成", "开始生成", "是否确认", "确定生成",
-            "生成工作流", "开始构建", "帮您生成", "立即生成",
-            "可以生成", "需要确认", "是否开始", "是否生成",
-            "方案如下", "以下步骤", "处理步骤", "工作流方案",
-            "帮您处理", "开始处理", "如您确认", "确认后",
-            "请确认", "好的", "明白", "了解", "没问题", "可以"
-        ]
-        
-        for keyword in confirm_keywords:
-            if keyword in ai_reply:
-                return "confirmed"
-        
-        return "clarifying"
+        return "confirmed" if _CONFIRM_RE.search(ai_reply) else "clarifying"
 
 
 # 单例
@@ -2,15 +2,21 @@
 豆包AI服务 - 将自然语言转换为工作流配置
 """
 import httpx
-import json
-import re
+import orjson
 import logging
 from typing import Dict, Any, List
 from config import ARK_API_KEY, ARK_BASE_URL, ARK_MODEL_NAME
+from utils import extract_json
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def _dumps_pretty(obj: Any) -> str:
+    """缩进格式的JSON文本（中文原样输出），用于拼入提示词"""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS, default=str).decode()
+
+
 WORKFLOW_GENERATION_PROMPT = """你是一个Excel工作流生成专家。根据用户需求生成JSON工作流。
 
 ## 可用节点类型
@@ -62,82 +68,76 @@ class AIService:
         self.api_key = ARK_API_KEY
         self.base_url = ARK_BASE_URL
         self.model = ARK_MODEL_NAME
+        # 全局复用的连接池，HTTP/2多路复用，避免每次请求重新握手
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
+            http2=True,
+            timeout=120.0,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+    
+    async def aclose(self):
+        """关闭连接池（应用关闭时调用）"""
+        await self.client.aclose()
     
     def _extract_json(self, content: str) -> Dict[str, Any]:
-        try:
-            return json.loads(content.strip())
-        except json.JSONDecodeError:
-            pass
-        
-        patterns = [r'```json\s*([\s\S]*?)\s*```', r'```\s*([\s\S]*?)\s*```', r'\{[\s\S]*\}']
-        
-        for pattern in patterns:
-            match = re.search(pattern, content)
-            if match:
-                try:
-                    json_str = match.group(1) if '```' in pattern else match.group(0)
-                    return json.loads(json_str.strip())
-                except:
-                    continue
-        
-        raise ValueError("无法解析AI返回的JSON")
+        return extract_json(content)
     
     async def generate_workflow(self, user_input: str, files_info: List[Dict]) -> Dict[str, Any]:
-        files_info_str = json.dumps(files_info, ensure_ascii=False, indent=2)
+        files_info_str = _dumps_pretty(files_info)
         prompt = WORKFLOW_GENERATION_PROMPT.format(files_info=files_info_str, user_input=user_input)
         
         logger.info(f"调用AI生成工作流: {user_input[:100]}...")
         
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/chat/completions",
-                    headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
-                    json={
-                        "model": self.model,
-                        "messages": [
-                            {"role": "system", "content": "你是Excel处理专家，只返回JSON格式配置。"},
-                            {"role": "user", "content": prompt}
-                        ],
-                        "max_tokens": 4096,
-                        "temperature": 0.1
-                    }
-                )
-                
-                logger.info(f"AI API响应状态码: {response.status_code}")
-                
-                if response.status_code != 200:
-                    raise Exception(f"AI API调用失败: {response.text[:200]}")
-                
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-                logger.info(f"AI返回内容: {content[:300]}...")
-                
-                workflow_config = self._extract_json(content)
-                
-                if "nodes" not in workflow_config:
-                    workflow_config["nodes"] = []
-                if "edges" not in workflow_config:
-                    workflow_config["edges"] = []
-                
-                return workflow_config
-                
+            response = await self.client.post(
+                "/chat/completions",
+                json={
+                    "model": self.model,
+                    "messages": [
+                        {"role": "system", "content": "你是Excel处理专家，只返回JSON格式配置。"},
+                        {"role": "user", "content": prompt}
+                    ],
+                    "max_tokens": 4096,
+                    "temperature": 0.1
+                },
+                timeout=120.0
+            )
+            
+            logger.info(f"AI API响应状态码: {response.status_code}")
+            
+            if response.status_code != 200:
+                raise Exception(f"AI API调用失败: {response.text[:200]}")
+            
+            result = orjson.loads(response.content)
+            content = result["choices"][0]["message"]["content"]
+            logger.info(f"AI返回内容: {content[:300]}...")
+            
+            workflow_config = self._extract_json(content)
+            
+            if "nodes" not in workflow_config:
+                workflow_config["nodes"] = []
+            if "edges" not in workflow_config:
+                workflow_config["edges"] = []
+            
+            return workflow_config
+            
         except Exception as e:
             logger.error(f"生成工作流错误: {e}")
             raise
     
     async def explain_workflow(self, workflow_config: Dict) -> str:
-        prompt = f"请用简洁中文解释这个工作流：\n\n{json.dumps(workflow_config, ensure_ascii=False, indent=2)}"
+        prompt = f"请用简洁中文解释这个工作流：\n\n{_dumps_pretty(workflow_config)}"
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/chat/completions",
-                    headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
-                    json={"model": self.model, "messages": [{"role": "user", "content": prompt}], "max_tokens": 500}
-                )
-                if response.status_code == 200:
-                    return response.json()["choices"][0]["message"]["content"]
-                return "无法生成解释"
+            response = await self.client.post(
+                "/chat/completions",
+                json={"model": self.model, "messages": [{"role": "user", "content": prompt}], "max_tokens": 500},
+                timeout=30.0
+            )
+            if response.status_code == 200:
+                return orjson.loads(response.content)["choices"][0]["message"]["content"]
+            return "无法生成解释"
         except:
             return "无法生成解释"
 
@@ -2,14 +2,179 @@
 Excel处理服务
 """
 import os
+import glob
+import asyncio
 import uuid
-import json
-from typing import List, Dict, Any, Optional
+import orjson
+import logging
+import functools
+from urllib.parse import quote
+from typing import List, Dict, Any, Optional, Tuple
 import pandas as pd
-from openpyxl import load_workbook
-import aiosqlite
-from config import UPLOAD_DIR
-from database import DATABASE_PATH
+import pyarrow as pa
+from cachetools import TTLCache
+import pyarrow.csv as pacsv
+from python_calamine import CalamineWorkbook
+from config import UPLOAD_DIR, SHEET_CACHE_DIR
+from database import get_connection
+from services.xlsx_peek import peek_xlsx, peek_xlsx_async
+
+logger = logging.getLogger(__name__)
+
+SHEETS_CACHE_TTL = 600  # 已解析sheets元数据的缓存时间（秒）
+SHEETS_CACHE_MAX = 1024  # 最多缓存的文件数
+EXCEL_MAX_ROWS = 1048576  # xlsx单表行数上限（含表头）
+EXPORT_CHUNK_ROWS = 10000  # 导出xlsx时每次转换的行数
+
+# file_id -> 已解析的sheets列表（有容量上限，过期条目自动淘汰）
+_sheets_cache: TTLCache = TTLCache(maxsize=SHEETS_CACHE_MAX, ttl=SHEETS_CACHE_TTL)
+
+
+def _normalize_cell(value: Any) -> Any:
+    """将calamine单元格值对齐为openpyxl风格：空单元格为None，整数值的浮点数转为int"""
+    if value == "":
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _header_columns(first_row: List[Any]) -> List[str]:
+    """
+    由第一行生成列名，与pd.read_excel读出的列名一致：
+    空表头为“Unnamed: N”，重名列依次加“.1”、“.2”后缀
+    """
+    names = [str(cell) if cell is not None else f"Unnamed: {i}"
+             for i, cell in enumerate(map(_normalize_cell, first_row))]
+    counts: Dict[str, int] = {}
+    for i, name in enumerate(names):
+        count = counts.get(name, 0)
+        while count > 0:
+            counts[name] = count + 1
+            name = f"{name}.{count}"
+            count = counts.get(name, 0)
+        names[i] = name
+        counts[name] = count + 1
+    return names
+
+
+@functools.lru_cache(maxsize=32)
+def _load_sheet(file_path: str, mtime_ns: int, sheet_name: str):
+    """
+    加载并缓存已解析的Sheet（mtime参与缓存键，文件变化后自动失效）
+    
+    缓存的是内存中的CalamineSheet而非工作簿句柄：Sheet只读、可跨线程共享，
+    且加载完即释放文件句柄，不影响后续删除文件。
+    """
+    return CalamineWorkbook.from_path(file_path).get_sheet_by_name(sheet_name)
+
+
+def _peek_calamine_sheet(file_path: str, sheet_name: str) -> Tuple[str, List[List[Any]], int]:
+    """用calamine读取单个Sheet的表头+前5行和总行数（每个线程各自打开工作簿）"""
+    sheet = CalamineWorkbook.from_path(file_path).get_sheet_by_name(sheet_name)
+    return sheet_name, sheet.to_python(nrows=6), sheet.height
+
+
+def _sidecar_path(file_path: str, sheet_name: str) -> str:
+    """Sheet对应的Parquet缓存文件路径（单独目录，避免被按file_id前缀查找上传文件时误匹配）"""
+    return os.path.join(SHEET_CACHE_DIR, f"{os.path.basename(file_path)}.{quote(sheet_name, safe='')}.parquet")
+
+
+@functools.lru_cache(maxsize=32)
+def _read_dataframe(file_path: str, mtime_ns: int, sheet_name: str) -> pd.DataFrame:
+    """
+    读取并缓存整张Sheet的DataFrame（调用方需copy后再修改）
+    
+    首次解析Excel后写出Parquet缓存，之后优先读取比源文件新的Parquet；
+    无法写成Parquet的表（如混合类型列、非字符串列名）直接跳过缓存。
+    """
+    sidecar = _sidecar_path(file_path, sheet_name)
+    try:
+        if os.stat(sidecar).st_mtime_ns >= mtime_ns:
+            return pd.read_parquet(sidecar)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("读取Parquet缓存失败，改为解析Excel: %s", e)
+    
+    df = pd.read_excel(file_path, sheet_name=sheet_name, engine="calamine")
+    tmp_path = f"{sidecar}.tmp"
+    try:
+        df.to_parquet(tmp_path, compression="zstd")
+        os.replace(tmp_path, sidecar)
+    except Exception as e:
+        logger.debug("跳过Parquet缓存 %s/%s: %s", file_path, sheet_name, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return df
+
+
+def _write_xlsx(df: pd.DataFrame, output_path: str) -> None:
+    """
+    用xlsxwriter的constant_memory模式逐行写出xlsx，写完的行立即落盘
+    
+    pandas的to_excel按列写单元格，与constant_memory（只保留当前行）不兼容，
+    因此这里按块转换为Python对象后逐行写入。
+    """
+    import xlsxwriter
+    
+    if len(df) >= EXCEL_MAX_ROWS:
+        raise ValueError(f"数据共{len(df)}行，超出Excel单表上限{EXCEL_MAX_ROWS - 1}行，请改用CSV导出")
+    
+    workbook = xlsxwriter.Workbook(output_path, {
+        "constant_memory": True,
+        "strings_to_urls": False,
+        "remove_timezone": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+    })
+    try:
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, [str(c) for c in df.columns])
+        row_idx = 1
+        for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+            chunk = df.iloc[start:start + EXPORT_CHUNK_ROWS]
+            # 缺失值（NaN/NaT/NA）写为空单元格
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            for values in chunk.itertuples(index=False, name=None):
+                worksheet.write_row(row_idx, 0, values)
+                row_idx += 1
+    finally:
+        workbook.close()
+
+
+def _write_csv(df: pd.DataFrame, output_path: str, encoding: str = "utf-8") -> None:
+    """
+    导出CSV：全数值列的表用pyarrow按列写出（C实现），其余情况用DataFrame.to_csv
+    
+    pyarrow会给字符串值加引号、布尔值写为true/false，与to_csv的输出不同，因此只用于纯数值表；
+    数值格式仅整数值的浮点数不同（1.0写为1），解析结果一致。
+    """
+    numeric = len(df.columns) > 0 and all(
+        pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+        for dtype in df.dtypes
+    )
+    if numeric and encoding.replace("-", "").lower() == "utf8" and df.columns.is_unique:
+        try:
+            table = pa.Table.from_pandas(df.rename(columns=str), preserve_index=False)
+            pacsv.write_csv(table, output_path, write_options=pacsv.WriteOptions(quoting_style="none"))
+            return
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+            # 列名含逗号等需要引号的字符时，quoting_style="none"无法写出
+            logger.debug("pyarrow写CSV失败，改用pandas: %s", e)
+    df.to_csv(output_path, index=False, encoding=encoding)
+
+
+def _cache_sheets(file_id: str, sheets: List[Dict]) -> List[Dict]:
+    _sheets_cache[file_id] = sheets
+    return sheets
+
+
+def _load_sheets(file_id: str, raw: Optional[str]) -> List[Dict]:
+    """返回已解析的sheets，缓存命中时跳过JSON反序列化"""
+    sheets = _sheets_cache.get(file_id)
+    if sheets is not None:
+        return sheets
+    return _cache_sheets(file_id, orjson.loads(raw) if raw else [])
 
 
 class ExcelService:
@@ -32,26 +197,41 @@ class ExcelService:
                 ]
             }
         """
-        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        return ExcelService._build_sheets_info(ExcelService._peek_sheets(file_path))
+    
+    @staticmethod
+    async def parse_excel_async(file_path: str) -> Dict[str, Any]:
+        """
+        parse_excel的异步版本：各Sheet在线程中并发解析，不阻塞事件循环
+        """
+        peeked = None
+        if file_path.lower().endswith((".xlsx", ".xlsm")):
+            try:
+                peeked = await peek_xlsx_async(file_path, nrows=6)
+            except Exception as e:
+                logger.debug("xlsx快速预览失败，改用calamine: %s", e)
+        
+        if peeked is None:
+            workbook = await asyncio.to_thread(CalamineWorkbook.from_path, file_path)
+            peeked = await asyncio.gather(
+                *[asyncio.to_thread(_peek_calamine_sheet, file_path, name) for name in workbook.sheet_names]
+            )
+        return ExcelService._build_sheets_info(peeked)
+    
+    @staticmethod
+    def _build_sheets_info(peeked: List[Tuple[str, List[List[Any]], int]]) -> Dict[str, Any]:
+        """由(sheet名, 表头+前5行, 总行数)生成sheets元数据"""
         sheets_info = []
         
-        for sheet_name in workbook.sheetnames:
-            sheet = workbook[sheet_name]
-            
+        for sheet_name, rows, height in peeked:
             # 获取列名（第一行）
-            columns = []
-            first_row = next(sheet.iter_rows(min_row=1, max_row=1, values_only=True), None)
-            if first_row:
-                columns = [str(cell) if cell is not None else f"列{i+1}" 
-                          for i, cell in enumerate(first_row)]
+            columns = _header_columns(rows[0]) if rows else []
             
             # 获取行数
-            row_count = sheet.max_row - 1 if sheet.max_row else 0
+            row_count = max(height - 1, 0)
             
             # 获取预览数据（前5行）
-            preview = []
-            for row in sheet.iter_rows(min_row=2, max_row=6, values_only=True):
-                preview.append(list(row))
+            preview = [[_normalize_cell(cell) for cell in row] for row in rows[1:6]]
             
             sheets_info.append({
                 "name": sheet_name,
@@ -60,69 +240,180 @@ class ExcelService:
                 "preview": preview
             })
         
-        workbook.close()
         return {"sheets": sheets_info}
     
+    @staticmethod
+    def _peek_sheets(file_path: str) -> List[Tuple[str, List[List[Any]], int]]:
+        """
+        读取每个Sheet的表头+前5行和总行数
+        
+        xlsx直接读取ZIP内的XML，只解析前几行；其他格式或结构异常时用calamine整表加载
+        """
+        if file_path.lower().endswith((".xlsx", ".xlsm")):
+            try:
+                peeked = peek_xlsx(file_path, nrows=6)
+                if peeked is not None:
+                    return peeked
+            except Exception as e:
+                logger.debug("xlsx快速预览失败，改用calamine: %s", e)
+        
+        workbook = CalamineWorkbook.from_path(file_path)
+        result = []
+        for sheet_name in workbook.sheet_names:
+            sheet = workbook.get_sheet_by_name(sheet_name)
+            result.append((sheet_name, sheet.to_python(nrows=6), sheet.height))
+        return result
+    
+    @staticmethod
+    def preview_sheet(file_path: str, sheet_name: str, rows: int = 10) -> Dict[str, Any]:
+        """
+        预览Sheet前N行，重复预览同一Sheet时直接命中内存缓存
+        
+        Returns:
+            {"columns": [...], "data": [[第1列的值, ...], ...], "total_rows": 100}
+        """
+        sheet = _load_sheet(file_path, os.stat(file_path).st_mtime_ns, sheet_name)
+        values = sheet.to_python(nrows=rows + 1)
+        
+        columns = _header_columns(values[0]) if values else []
+        
+        # 列式输出：每列一个列表（与columns按位置对应），避免逐行构造dict
+        body = values[1:]
+        data = [
+            ["" if cell is None else cell for cell in (_normalize_cell(row[i]) for row in body)]
+            for i in range(len(columns))
+        ]
+        return {
+            "columns": columns,
+            "data": data,
+            "total_rows": max(sheet.height - 1, 0)
+        }
+    
+    @staticmethod
+    def remove_sheet_cache_files(file_path: str) -> None:
+        """删除文件对应的全部Parquet缓存"""
+        pattern = os.path.join(SHEET_CACHE_DIR, f"{glob.escape(os.path.basename(file_path))}.*.parquet")
+        for sidecar in glob.glob(pattern):
+            os.remove(sidecar)
+    
     @staticmethod
     def read_sheet_as_dataframe(file_path: str, sheet_name: str) -> pd.DataFrame:
-        """读取指定Sheet为DataFrame"""
-        return pd.read_excel(file_path, sheet_name=sheet_name)
+        """读取指定Sheet为DataFrame（同一文件版本只解析一次）"""
+        # 浅拷贝不复制数据：工作流节点修改前会自行复制，新增/替换列不影响缓存
+        return _read_dataframe(file_path, os.stat(file_path).st_mtime_ns, sheet_name).copy(deep=False)
     
     @staticmethod
     def read_column(file_path: str, sheet_name: str, column_name: str) -> pd.Series:
-        """读取指定列"""
-        df = pd.read_excel(file_path, sheet_name=sheet_name)
+        """读取指定列（复用已缓存的整表）"""
+        df = _read_dataframe(file_path, os.stat(file_path).st_mtime_ns, sheet_name)
         if column_name in df.columns:
-            return df[column_name]
+            return df[column_name].copy()
         raise ValueError(f"列 '{column_name}' 不存在于Sheet '{sheet_name}'")
     
     @staticmethod
     async def save_file_record(file_id: str, filename: str, original_name: str, 
-                               file_path: str, sheets: List[Dict]) -> None:
+                               file_path: str, sheets: List[Dict],
+                               content_hash: Optional[str] = None) -> None:
         """保存文件记录到数据库"""
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            await db.execute(
-                """INSERT INTO uploaded_files (id, filename, original_name, file_path, sheets)
-                   VALUES (?, ?, ?, ?, ?)""",
-                (file_id, filename, original_name, file_path, json.dumps(sheets, ensure_ascii=False))
+        await ExcelService.save_file_records([{
+            "file_id": file_id,
+            "filename": filename,
+            "original_name": original_name,
+            "file_path": file_path,
+            "sheets": sheets,
+            "content_hash": content_hash
+        }])
+    
+    @staticmethod
+    async def save_file_records(records: List[Dict]) -> None:
+        """批量保存文件记录（一次executemany、一次提交）"""
+        if not records:
+            return
+        rows = [
+            (r["file_id"], r["filename"], r["original_name"], r["file_path"],
+             orjson.dumps(r["sheets"], default=str).decode(), r.get("content_hash"))
+            for r in records
+        ]
+        async with get_connection() as db:
+            await db.executemany(
+                """INSERT INTO uploaded_files (id, filename, original_name, file_path, sheets, content_hash)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                rows
             )
             await db.commit()
+        for r in records:
+            _cache_sheets(r["file_id"], r["sheets"])
     
     @staticmethod
     async def get_file_record(file_id: str) -> Optional[Dict]:
-        """获取文件记录"""
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        """获取文件记录（sheets字段为已解析的列表）"""
+        async with get_connection() as db:
             cursor = await db.execute(
                 "SELECT * FROM uploaded_files WHERE id = ?", (file_id,)
             )
             row = await cursor.fetchone()
             if row:
-                return dict(row)
+                record = dict(row)
+                record["sheets"] = _load_sheets(file_id, record["sheets"])
+                return record
             return None
     
+    @staticmethod
+    async def find_file_by_hash(content_hash: str) -> Optional[Dict]:
+        """按内容哈希查找已上传的相同文件"""
+        async with get_connection() as db:
+            cursor = await db.execute(
+                "SELECT id FROM uploaded_files WHERE content_hash = ? LIMIT 1", (content_hash,)
+            )
+            row = await cursor.fetchone()
+        if row:
+            return await ExcelService.get_file_record(row["id"])
+        return None
+    
     @staticmethod
     async def delete_file_record(file_id: str) -> None:
         """从数据库删除文件记录"""
-        async with aiosqlite.connect(DATABASE_PATH) as db:
+        async with get_connection() as db:
             await db.execute(
                 "DELETE FROM uploaded_files WHERE id = ?", (file_id,)
             )
             await db.commit()
+        _sheets_cache.pop(file_id, None)
     
     @staticmethod
     async def get_all_files() -> List[Dict]:
-        """获取所有上传的文件"""
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        """获取所有上传的文件（sheets字段为已解析的列表）"""
+        async with get_connection() as db:
             cursor = await db.execute(
                 "SELECT * FROM uploaded_files ORDER BY created_at DESC"
             )
             rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+        files = []
+        for row in rows:
+            record = dict(row)
+            record["sheets"] = _load_sheets(record["id"], record["sheets"])
+            files.append(record)
+        return files
+    
+    @staticmethod
+    def export_csv(df: pd.DataFrame, output_path: str, encoding: str = "utf-8") -> str:
+        """导出DataFrame为CSV文件"""
+        _write_csv(df, output_path, encoding)
+        return output_path
     
     @staticmethod
     def export_dataframe(df: pd.DataFrame, output_path: str) -> str:
-        """导出DataFrame为Excel文件"""
-        df.to_excel(output_path, index=False)
+        """导出DataFrame为Excel文件（.csv/.parquet后缀时导出为对应格式，速度更快）"""
+        lower_path = output_path.lower()
+        if lower_path.endswith(".csv"):
+            _write_csv(df, output_path)
+        elif lower_path.endswith(".parquet"):
+            # 列名统一为字符串，混合类型的object列转为字符串，保证pyarrow可写
+            out = df.rename(columns=str)
+            for col in out.columns[(out.dtypes == object).to_numpy()]:
+                if pd.api.types.infer_dtype(out[col], skipna=True) in ("mixed", "mixed-integer"):
+                    out[col] = out[col].astype(str).where(out[col].notna(), None)
+            out.to_parquet(output_path, engine="pyarrow", compression="zstd", index=False)
+        else:
+            _write_xlsx(df, output_path)
         return output_path
@@ -0,0 +1,39 @@
+"""
+LLM响应缓存 - 确定性调用（temperature=0）的回复持久化到SQLite
+"""
+import hashlib
+import logging
+import time
+from typing import List, Optional
+import orjson
+from database import get_connection
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_TTL = 86400  # 缓存有效期（秒）
+
+
+def cache_key(model: str, temperature: float, messages: List[dict]) -> str:
+    """(模型, 温度, 消息列表)的SHA-256摘要"""
+    return hashlib.sha256(orjson.dumps([model, temperature, messages])).hexdigest()
+
+
+async def get_cached(key: str) -> Optional[str]:
+    """读取未过期的缓存回复"""
+    async with get_connection() as db:
+        cursor = await db.execute(
+            "SELECT content FROM llm_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        )
+        row = await cursor.fetchone()
+    return row["content"] if row else None
+
+
+async def set_cached(key: str, content: str, ttl: int = LLM_CACHE_TTL):
+    """写入缓存回复（同key覆盖）"""
+    async with get_connection() as db:
+        await db.execute(
+            """INSERT INTO llm_cache (key, content, expires_at) VALUES (?, ?, ?)
+               ON CONFLICT(key) DO UPDATE SET content = excluded.content, expires_at = excluded.expires_at""",
+            (key, content, time.time() + ttl)
+        )
+        await db.commit()
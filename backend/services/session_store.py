@@ -0,0 +1,72 @@
+"""
+对话会话存储
+配置了REDIS_URL时使用Redis（msgpack序列化，多worker共享），否则使用进程内TTL缓存
+"""
+import logging
+from typing import Optional
+from cachetools import TTLCache
+from config import REDIS_URL, SESSION_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class MemorySessionStore:
+    """进程内会话存储，超过TTL或容量时按最近使用淘汰"""
+
+    def __init__(self, maxsize: int = 10000, ttl: int = SESSION_TTL):
+        self._sessions: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        return self._sessions.get(session_id)
+
+    async def set(self, session_id: str, session: dict) -> None:
+        self._sessions[session_id] = session
+
+    async def delete(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+    async def aclose(self) -> None:
+        pass
+
+
+class RedisSessionStore:
+    """Redis会话存储，会话以msgpack二进制保存并设置过期时间"""
+
+    def __init__(self, url: str, ttl: int = SESSION_TTL, max_connections: int = 50):
+        import msgpack
+        from redis.asyncio import ConnectionPool, Redis
+
+        self._packb = msgpack.packb
+        self._unpackb = msgpack.unpackb
+        self._ttl = ttl
+        self._redis = Redis(connection_pool=ConnectionPool.from_url(url, max_connections=max_connections))
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"sess:{session_id}"
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        raw = await self._redis.get(self._key(session_id))
+        if raw is None:
+            return None
+        return self._unpackb(raw)
+
+    async def set(self, session_id: str, session: dict) -> None:
+        await self._redis.set(self._key(session_id), self._packb(session, default=str), ex=self._ttl)
+
+    async def delete(self, session_id: str) -> None:
+        await self._redis.delete(self._key(session_id))
+
+    async def aclose(self) -> None:
+        await self._redis.aclose()
+
+
+def _create_store():
+    if REDIS_URL:
+        logger.info("使用Redis会话存储")
+        return RedisSessionStore(REDIS_URL)
+    return MemorySessionStore()
+
+
+# 单例
+session_store = _create_store()
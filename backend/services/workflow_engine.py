@@ -1,14 +1,29 @@
 import pandas as pd
-import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import orjson
 import asyncio
 import logging
 import os
 import re
-from typing import Dict, List, Any, Optional
+import time
+import functools
+import multiprocessing
+import random
+import httpx
+import types
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Any, Optional, Tuple
+from cachetools import LRUCache
 from uuid import uuid4
 from datetime import datetime, timedelta
-from config import UPLOAD_DIR
+from config import UPLOAD_DIR, ARK_API_KEY, ARK_BASE_URL, ARK_MODEL_NAME, ARK_MAX_CONCURRENCY
+from database import get_connection
+from utils import fingerprint, AdaptiveLimiter
 from services.ai_service import ai_service
+from services.excel_service import ExcelService, EXCEL_MAX_ROWS
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -18,31 +33,307 @@ class WorkflowContext:
     """工作流执行上下文，存储节点结果"""
     def __init__(self):
         self._results: Dict[str, pd.DataFrame] = {}
-        self._logs: List[str] = []
+        self._keys: Dict[str, str] = {}  # 节点ID -> 结果缓存键
+        # (perf_counter_ns, 消息)，返回结果时才格式化时间戳
+        self._logs: List[Tuple[int, str]] = []
+        self._t0 = time.time()
+        self._t0_ns = time.perf_counter_ns()
     
-    def set_result(self, node_id: str, df: pd.DataFrame):
+    def set_result(self, node_id: str, df: pd.DataFrame, cache_key: Optional[str] = None):
         self._results[node_id] = df
+        if cache_key is not None:
+            self._keys[node_id] = cache_key
         
     def get_result(self, node_id: str) -> Optional[pd.DataFrame]:
         return self._results.get(node_id)
     
+    def get_key(self, node_id: str) -> Optional[str]:
+        return self._keys.get(node_id)
+    
     def get_all_results(self) -> Dict[str, pd.DataFrame]:
         return self._results
         
     def log(self, message: str):
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        self._logs.append(f"[{timestamp}] {message}")
-        print(f"[{timestamp}] {message}")
+        self._logs.append((time.perf_counter_ns(), message))
+        logger.info(message)
+    
+    def rendered_logs(self) -> List[str]:
+        """格式化为 "[HH:MM:SS] 消息" 列表"""
+        return [
+            f"[{datetime.fromtimestamp(self._t0 + (ns - self._t0_ns) / 1e9).strftime('%H:%M:%S')}] {message}"
+            for ns, message in self._logs
+        ]
+
+
+# CPU密集的节点在子进程中执行以绕过GIL：节点类型 -> (方法名, 输入表个数)
+# code节点执行用户代码、依赖上下文，始终留在本进程
+_PROCESS_KERNELS = {
+    'transform': ('_execute_transform', 1),
+    'group_aggregate': ('_execute_group_aggregate', 1),
+    'pivot': ('_execute_pivot', 1),
+    'join': ('_execute_join', 2),
+    'reconcile': ('_execute_reconcile', 2),
+}
+# 输入总行数低于该值时，进程间传输DataFrame的开销大于并行收益，仍在线程中执行
+PROCESS_POOL_MIN_ROWS = 100_000
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    """懒创建进程池（spawn方式，避免fork带有线程的父进程）"""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_pool
+
+
+def shutdown_process_pool():
+    """关闭进程池（应用关闭时调用）"""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+def _run_kernel(method_name: str, input_dfs: List[pd.DataFrame], config: Dict) -> pd.DataFrame:
+    """子进程入口：用子进程内的引擎实例执行节点计算"""
+    return getattr(workflow_engine, method_name)(*input_dfs, config)
+
+
+def _align_key_dtypes(df1: pd.DataFrame, df2: pd.DataFrame, keys1: List[str], keys2: List[str]) -> None:
+    """
+    对齐两表关联键的类型（原地修改，调用方需传入副本）
+    
+    类型一致时不做转换；两侧都是数值（或可整体转为数值）时统一为数值；
+    否则才转成字符串，并编码为共享类别的Categorical，让merge在整数编码上做哈希。
+    """
+    for k1, k2 in zip(keys1, keys2):
+        s1, s2 = df1[k1], df2[k2]
+        if s1.dtype == s2.dtype and (s1.dtype != object or (
+                pd.api.types.infer_dtype(s1, skipna=True) == pd.api.types.infer_dtype(s2, skipna=True) == 'string')):
+            continue
+        
+        n1, n2 = _try_numeric(s1), _try_numeric(s2)
+        if n1 is not None and n2 is not None:
+            if n1.dtype != n2.dtype:
+                n1, n2 = n1.astype('float64'), n2.astype('float64')
+            df1[k1], df2[k2] = n1, n2
+            continue
+        
+        str1, str2 = s1.astype(str), s2.astype(str)
+        categories = pd.Index(str1.unique()).union(pd.Index(str2.unique()))
+        df1[k1] = pd.Categorical(str1, categories=categories)
+        df2[k2] = pd.Categorical(str2, categories=categories)
+
+
+def _try_numeric(series: pd.Series) -> Optional[pd.Series]:
+    """数值列原样返回；可整体转为数值的列返回转换结果；否则返回None"""
+    if pd.api.types.is_numeric_dtype(series):
+        return series
+    if series.dtype != object:
+        return None
+    try:
+        return pd.to_numeric(series)
+    except (ValueError, TypeError):
+        return None
+
+
+def _restore_key_dtypes(df: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+    """merge后把Categorical关联键还原为普通列，避免下游fillna等操作受类别限制"""
+    for key in keys:
+        if key in df.columns and isinstance(df[key].dtype, pd.CategoricalDtype):
+            df[key] = df[key].astype(object)
+    return df
+
+
+def _read_csv_arrow(file_path: str, delimiter: str, encoding: str) -> pd.DataFrame:
+    """
+    用pyarrow多线程读取CSV（内存映射文件）
+    
+    转为普通numpy/object列而非ArrowDtype，下游节点的fillna("")、填充数值等操作保持原有行为；
+    空字符串按缺失值处理，与pd.read_csv一致。
+    pyarrow会把ISO格式的日期/时间推断为日期类型，而pd.read_csv保留为字符串，
+    出现此类列时按字符串重新读取，保证与原有dtype一致。
+    """
+    def read(column_types: Optional[Dict[str, Any]] = None) -> pa.Table:
+        with pa.memory_map(file_path) as source:
+            return pacsv.read_csv(
+                source,
+                read_options=pacsv.ReadOptions(encoding=encoding, use_threads=True),
+                parse_options=pacsv.ParseOptions(delimiter=delimiter),
+                convert_options=pacsv.ConvertOptions(strings_can_be_null=True, column_types=column_types)
+            )
+    
+    table = read()
+    temporal = {
+        field.name: pa.string() for field in table.schema
+        if pa.types.is_temporal(field.type)
+    }
+    if temporal:
+        table = read(temporal)
+    return table.to_pandas()
+
+
+# 节点结果缓存：键由节点类型、配置和上游节点的键逐级派生（数据源取文件路径和mtime），
+# 重跑工作流时未变化的节点直接复用上次结果
+NODE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# 结果不确定或有副作用的节点不缓存，其下游也随之不缓存
+_UNCACHEABLE_NODES = frozenset({'code', 'ai_agent', 'output', 'output_csv'})
+
+
+def _estimate_nbytes(df: pd.DataFrame) -> int:
+    """估算DataFrame占用内存（object列按每格64字节估算，避免deep=True遍历所有对象）"""
+    n_object = int((df.dtypes == object).sum())
+    return int(df.memory_usage(index=False, deep=False).sum()) + n_object * len(df) * 56 + 1
+
+
+_node_cache: LRUCache = LRUCache(maxsize=NODE_CACHE_MAX_BYTES, getsizeof=_estimate_nbytes)
+
+# 已解析的工作流配置：workflow_id -> (updated_at, config)，updated_at变化即视为失效
+_config_cache: LRUCache = LRUCache(maxsize=128)
+
+
+@functools.lru_cache(maxsize=4)
+def _upload_index(dir_mtime_ns: int) -> Dict[str, str]:
+    """上传目录索引：文件名（不含扩展名）-> 路径（目录mtime参与缓存键，增删文件后自动失效）"""
+    with os.scandir(UPLOAD_DIR) as entries:
+        return {os.path.splitext(e.name)[0]: e.path for e in entries if e.is_file()}
+
+
+def _find_upload(mapped_id: str) -> Optional[str]:
+    """按文件ID查找上传文件：先精确匹配，再兼容旧的前缀匹配"""
+    path = _lookup_upload(_upload_index(os.stat(UPLOAD_DIR).st_mtime_ns), mapped_id)
+    if path is None:
+        # mtime精度较粗或同一时刻有多次上传时索引可能过期，未找到时重建一次再查
+        _upload_index.cache_clear()
+        path = _lookup_upload(_upload_index(os.stat(UPLOAD_DIR).st_mtime_ns), mapped_id)
+    return path
+
+
+def _lookup_upload(index: Dict[str, str], mapped_id: str) -> Optional[str]:
+    path = index.get(mapped_id)
+    if path is None:
+        path = next((p for stem, p in index.items() if stem.startswith(mapped_id)), None)
+    return path
+
+
+# 节点结果返回给前端预览的最大行数
+NODE_PREVIEW_ROWS = 1000
+
+def _df_to_preview(df: pd.DataFrame, limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    生成split格式的预览：{"columns": [...], "data": [[值, ...], ...], "total_rows": N}
+    
+    缺失值（NaN/NaT/NA）在转换时直接置为None（JSON中为null），无需先fillna复制整表。
+    """
+    head = df if limit is None else df.head(limit)
+    return {
+        "columns": head.columns.tolist(),
+        "data": head.to_numpy(dtype=object, na_value=None).tolist(),
+        "total_rows": len(df)
+    }
+
+
+# 日期偏移配置，如 "+7d"、"-1M"、"1y"
+_OFFSET_RE = re.compile(r'([+-]?\d+)([dMy])')
+
+# 日期提取项 -> (新列名, 提取结果)
+_DT_EXTRACTS = {
+    'year': lambda s, c: (f'{c}_年', s.dt.year),
+    'month': lambda s, c: (f'{c}_月', s.dt.month),
+    'day': lambda s, c: (f'{c}_日', s.dt.day),
+    'weekday': lambda s, c: (f'{c}_周几', s.dt.dayofweek + 1),
+    'quarter': lambda s, c: (f'{c}_季度', s.dt.quarter),
+}
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_user_code(src: str) -> types.CodeType:
+    """编译代码节点源码，相同源码复用已编译的代码对象"""
+    return compile(src, '<node_code>', 'exec')
+
+
+# 节点类型 -> (方法名, 输入表数量, 输入不足时的报错)
+# 数量为0的数据源节点以(config, file_mapping)调用；None表示接收全部输入列表；
+# 报错为None时输入不足直接返回None。code、output节点在分发前单独处理
+_NODE_HANDLERS = {
+    # 数据源
+    'source': ('_execute_source', 0, None),
+    'source_csv': ('_execute_source_csv', 0, None),
+    # 数据清洗
+    'transform': ('_execute_transform', 1, None),
+    'type_convert': ('_execute_type_convert', 1, None),
+    'fill_na': ('_execute_fill_na', 1, None),
+    'deduplicate': ('_execute_deduplicate', 1, None),
+    'text_process': ('_execute_text_process', 1, None),
+    'date_process': ('_execute_date_process', 1, None),
+    # 数据分析
+    'group_aggregate': ('_execute_group_aggregate', 1, None),
+    'pivot': ('_execute_pivot', 1, None),
+    'unpivot': ('_execute_unpivot', 1, None),
+    # 多表操作
+    'join': ('_execute_join', 2, "合并节点需要至少两个输入"),
+    'concat': ('_execute_concat', None, None),
+    'vlookup': ('_execute_vlookup', 2, "VLOOKUP需要两个输入"),
+    'diff': ('_execute_diff', 2, "对比需要两个输入"),
+    'reconcile': ('_execute_reconcile', 2, "对账核算需要两个输入：明细表和汇总表"),
+}
+
+# AI Agent节点调用ARK接口的全局并发限制（同一波次的多个AI节点、并发执行的工作流共用）
+_ai_limiter = AdaptiveLimiter(ARK_MAX_CONCURRENCY)
+
+# 可重试的HTTP状态码（限流、网关/服务暂时不可用）及最多尝试次数
+AI_RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+AI_MAX_ATTEMPTS = 5
+
+
+def _retry_after(headers) -> Optional[float]:
+    """解析retry-after响应头（秒）"""
+    try:
+        return float(headers.get("retry-after", ""))
+    except (TypeError, ValueError):
+        return None
+
+
+def _node_data(node: Dict) -> Dict:
+    """兼容两种节点格式：{"data": {...}} 或平铺字段"""
+    return node['data'] if 'data' in node else node
+
 
 class WorkflowEngine:
-    async def execute_workflow(self, workflow_config: Dict, file_mapping: Dict[str, str]) -> Dict:
+    def __init__(self):
+        # AI Agent节点共用的连接池（HTTP/2多路复用），不要在逐行调用中临时创建客户端
+        self._http = httpx.AsyncClient(
+            base_url=ARK_BASE_URL,
+            headers={"Authorization": f"Bearer {ARK_API_KEY}", "Content-Type": "application/json"},
+            http2=True,
+            timeout=60.0,
+            # 空闲连接保留30秒（默认5秒），相邻两次执行之间不必重新握手
+            limits=httpx.Limits(max_connections=ARK_MAX_CONCURRENCY, max_keepalive_connections=ARK_MAX_CONCURRENCY,
+                                keepalive_expiry=30.0)
+        )
+    
+    async def aclose(self):
+        """关闭连接池（应用关闭时调用）"""
+        await self._http.aclose()
+    
+    async def execute_workflow(self, workflow_config: Dict, file_mapping: Dict[str, str],
+                               workflow_id: Optional[str] = None) -> Dict:
         """执行工作流"""
         context = WorkflowContext()
+        node_details = []  # 各节点的执行情况，结束时随本次执行的一条历史记录写入
+        run_error = None
+        input_files = orjson.dumps(list(file_mapping.values())).decode()
         nodes = workflow_config.get("nodes", [])
         edges = workflow_config.get("edges", [])
         
-        # 构建图的邻接表
+        # 构建图的邻接表，同时记录每个节点的上游（按连线原顺序，join等节点区分左右表）
         adj = {node['id']: [] for node in nodes}
+        in_edges = {node['id']: [] for node in nodes}
         in_degree = {node['id']: 0 for node in nodes}
         node_map = {node['id']: node for node in nodes}
         
@@ -51,19 +342,22 @@ class WorkflowEngine:
             target = edge['target']
             if source in adj and target in in_degree:
                 adj[source].append(target)
+                in_edges[target].append(source)
                 in_degree[target] += 1
         
-        # 拓扑排序
-        queue = [node['id'] for node in nodes if in_degree[node['id']] == 0]
-        execution_order = []
+        # 拓扑排序（Kahn算法），按波次分组：同一波次的节点互不依赖，可并发执行
+        queue = deque(node['id'] for node in nodes if in_degree[node['id']] == 0)
+        waves = []
         
         while queue:
-            node_id = queue.pop(0)
-            execution_order.append(node_id)
-            for neighbor in adj[node_id]:
-                in_degree[neighbor] -= 1
-                if in_degree[neighbor] == 0:
-                    queue.append(neighbor)
+            wave = list(queue)
+            queue.clear()
+            waves.append(wave)
+            for node_id in wave:
+                for neighbor in adj[node_id]:
+                    in_degree[neighbor] -= 1
+                    if in_degree[neighbor] == 0:
+                        queue.append(neighbor)
         
         # 执行
         output_file = None
@@ -76,214 +370,226 @@ class WorkflowEngine:
             node_status[node['id']] = 'pending'
         
         try:
-            for node_id in execution_order:
-                if node_id not in node_map:
-                    continue
-                    
-                node = node_map[node_id]
-                
-                # 兼容两种节点格式
-                if 'data' in node:
-                    node_data = node['data']
-                else:
-                    node_data = node
-                
-                node_type = node_data.get('type')
-                node_label = node_data.get('label', node_type)
-                node_config = node_data.get('config', {})
-                
-                context.log(f"开始执行节点: {node_label} ({node_id})")
+            for wave in waves:
+                results = await asyncio.gather(
+                    *[self._run_node(node_map[node_id], in_edges[node_id], context, file_mapping) for node_id in wave],
+                    return_exceptions=True
+                )
                 
-                try:
-                    # 获取输入数据
-                    input_dfs = []
-                    for edge in edges:
-                        if edge['target'] == node_id:
-                            source_id = edge['source']
-                            df = context.get_result(source_id)
-                            if df is not None:
-                                input_dfs.append(df)
+                # 结果在gather返回后按顺序登记，避免并发写上下文
+                first_error = None
+                for node_id, result in zip(wave, results):
+                    node_data = _node_data(node_map[node_id])
+                    node_type = node_data.get('type')
+                    node_label = node_data.get('label', node_type)
                     
-                    # 执行节点
-                    result_df = await self._execute_node_by_type(node_type, node_config, input_dfs, context, file_mapping)
+                    if isinstance(result, BaseException):
+                        node_status[node_id] = 'error'
+                        node_results[node_id] = {"error": str(result)}
+                        context.log(f"节点 {node_label} 执行失败: {str(result)}")
+                        node_details.append({"node_id": node_id, "label": node_label,
+                                             "status": 'error', "summary": str(result)})
+                        first_error = first_error or result
+                        continue
                     
+                    result_df, node_output, cache_key = result
                     if result_df is not None:
-                        context.set_result(node_id, result_df)
+                        context.set_result(node_id, result_df, cache_key)
                         context.log(f"节点 {node_label} 执行成功，输出 {len(result_df)} 行数据")
                         
                         # 记录节点结果（用于前端预览）
                         node_status[node_id] = 'success'
-                        node_results[node_id] = {
-                            "columns": result_df.columns.tolist(),
-                            "data": result_df.fillna("").to_dict(orient="records"),  # 返回全部数据
-                            "total_rows": len(result_df)
-                        }
+                        # 只返回前NODE_PREVIEW_ROWS行，完整数据保留在上下文中
+                        preview = _df_to_preview(result_df, NODE_PREVIEW_ROWS)
+                        node_results[node_id] = preview
                         
-                        if node_type in ['output', 'output_csv']:
-                            output_file = self._save_output(result_df, node_config, node_type)
-                            final_preview = {
-                                "columns": result_df.columns.tolist(),
-                                "data": result_df.head(100).fillna("").to_dict(orient="records"),
-                                "total_rows": len(result_df)
-                            }
+                        if node_output is not None:
+                            output_file = node_output
+                            final_preview = {**preview, "data": preview["data"][:100]}
+                        node_details.append({"node_id": node_id, "label": node_label, "status": 'success',
+                                             "summary": f"输出 {len(result_df)} 行", "output_file": node_output})
                     else:
                         node_status[node_id] = 'success'  # 无输出但成功
-                        
-                except Exception as node_error:
-                    node_status[node_id] = 'error'
-                    node_results[node_id] = {"error": str(node_error)}
-                    context.log(f"节点 {node_label} 执行失败: {str(node_error)}")
-                    raise node_error  # 继续抛出，中断工作流
+                        node_details.append({"node_id": node_id, "label": node_label,
+                                             "status": 'success', "summary": "无输出"})
+                
+                if first_error is not None:
+                    raise first_error  # 继续抛出，中断工作流
             
             return {
                 "success": True,
                 "output_file": output_file,
                 "preview": final_preview,
-                "logs": context._logs,
+                "logs": context.rendered_logs(),
                 "node_status": node_status,
                 "node_results": node_results
             }
             
         except Exception as e:
+            run_error = str(e)
             logger.error(f"工作流执行失败: {str(e)}")
             import traceback
             traceback.print_exc()
             return {
                 "success": False,
                 "error": str(e),
-                "logs": context._logs,
+                "logs": context.rendered_logs(),
                 "node_status": node_status,
                 "node_results": node_results
             }
+        finally:
+            # 每次执行一条历史记录，节点明细以JSON保存在node_details列
+            if node_details:
+                summary = f"执行失败: {run_error}" if run_error else f"执行成功，共 {len(node_details)} 个节点"
+                try:
+                    await self.record_history_batch([(
+                        str(uuid4()), workflow_id, input_files, output_file,
+                        'error' if run_error else 'success', summary, orjson.dumps(node_details).decode()
+                    )])
+                except Exception as e:
+                    logger.warning(f"写入执行历史失败: {e}")
 
+    async def _run_node(self, node: Dict, sources: List[str], context: WorkflowContext,
+                        file_mapping: Dict) -> Tuple[Optional[pd.DataFrame], Optional[str], Optional[str]]:
+        """执行单个节点，返回(结果DataFrame, 输出文件名, 结果缓存键)"""
+        node_id = node['id']
+        node_data = _node_data(node)
+        node_type = node_data.get('type')
+        node_label = node_data.get('label', node_type)
+        node_config = node_data.get('config', {})
+        
+        context.log(f"开始执行节点: {node_label} ({node_id})")
+        
+        # 获取输入数据（上游节点都在之前的波次中完成）
+        input_dfs = []
+        input_keys = []
+        for source in sources:
+            df = context.get_result(source)
+            if df is not None:
+                input_dfs.append(df)
+                input_keys.append(context.get_key(source))
+        
+        cache_key = self._node_cache_key(node_type, node_config, input_keys, file_mapping)
+        result_df = _node_cache.get(cache_key) if cache_key is not None else None
+        if result_df is not None:
+            # 返回浅拷贝：下游各节点自行复制后再修改，新增/替换列不影响缓存中的对象
+            result_df = result_df.copy(deep=False)
+            context.log(f"节点 {node_label} 命中结果缓存")
+        else:
+            result_df = await self._execute_node_by_type(node_type, node_config, input_dfs, context, file_mapping)
+            # Excel数据源已由ExcelService缓存，不再重复保存
+            if cache_key is not None and result_df is not None and node_type != 'source':
+                try:
+                    _node_cache[cache_key] = result_df
+                except ValueError:
+                    # 结果超过缓存容量时不缓存，不影响本次执行
+                    logger.debug(f"节点 {node_label} 结果过大，跳过缓存")
+        
+        node_output = None
+        if result_df is not None and node_type in ['output', 'output_csv']:
+            node_output = await asyncio.to_thread(self._save_output, result_df, node_config, node_type)
+        return result_df, node_output, cache_key
+    
+    def _node_cache_key(self, node_type: str, config: Dict, input_keys: List[Optional[str]],
+                        file_mapping: Dict) -> Optional[str]:
+        """计算节点结果的缓存键，不可缓存时返回None"""
+        if node_type in _UNCACHEABLE_NODES or None in input_keys:
+            return None
+        if node_type in ('source', 'source_csv'):
+            file_id = config.get('file_id')
+            file_path = _find_upload(file_mapping.get(file_id, file_id))
+            if file_path is None:
+                return None
+            return fingerprint([node_type, config, file_path, os.stat(file_path).st_mtime_ns])
+        return fingerprint([node_type, config, input_keys])
+    
     async def _execute_node_by_type(self, node_type: str, config: Dict, input_dfs: List[pd.DataFrame], context: WorkflowContext, file_mapping: Dict) -> Optional[pd.DataFrame]:
-        """根据节点类型执行具体逻辑"""
-        
-        # ========== 数据源 ==========
-        if node_type == 'source':
-            return self._execute_source(config, file_mapping)
-            
-        elif node_type == 'source_csv':
-            return self._execute_source_csv(config, file_mapping)
-        
-        # ========== 数据清洗 ==========
-        elif node_type == 'transform':
-            if not input_dfs: return None
-            return self._execute_transform(input_dfs[0], config)
-            
-        elif node_type == 'type_convert':
-            if not input_dfs: return None
-            return self._execute_type_convert(input_dfs[0], config)
-            
-        elif node_type == 'fill_na':
-            if not input_dfs: return None
-            return self._execute_fill_na(input_dfs[0], config)
-            
-        elif node_type == 'deduplicate':
-            if not input_dfs: return None
-            return self._execute_deduplicate(input_dfs[0], config)
-            
-        elif node_type == 'text_process':
-            if not input_dfs: return None
-            return self._execute_text_process(input_dfs[0], config)
-            
-        elif node_type == 'date_process':
-            if not input_dfs: return None
-            return self._execute_date_process(input_dfs[0], config)
-        
-        # ========== 数据分析 ==========
-        elif node_type == 'group_aggregate':
-            if not input_dfs: return None
-            return self._execute_group_aggregate(input_dfs[0], config)
-            
-        elif node_type == 'pivot':
-            if not input_dfs: return None
-            return self._execute_pivot(input_dfs[0], config)
-            
-        elif node_type == 'unpivot':
-            if not input_dfs: return None
-            return self._execute_unpivot(input_dfs[0], config)
-        
-        # ========== 多表操作 ==========
-        elif node_type == 'join':
-            if len(input_dfs) < 2: 
-                raise ValueError("合并节点需要至少两个输入")
-            return self._execute_join(input_dfs[0], input_dfs[1], config)
-            
-        elif node_type == 'concat':
-            if not input_dfs: return None
-            return self._execute_concat(input_dfs, config)
-            
-        elif node_type == 'vlookup':
-            if len(input_dfs) < 2: 
-                raise ValueError("VLOOKUP需要两个输入")
-            return self._execute_vlookup(input_dfs[0], input_dfs[1], config)
-            
-        elif node_type == 'diff':
-            if len(input_dfs) < 2: 
-                raise ValueError("对比需要两个输入")
-            return self._execute_diff(input_dfs[0], input_dfs[1], config)
-        
-        elif node_type == 'reconcile':
-            if len(input_dfs) < 2:
-                raise ValueError("对账核算需要两个输入：明细表和汇总表")
-            return self._execute_reconcile(input_dfs[0], input_dfs[1], config)
-        
-        # ========== AI/自动化 ==========
-        elif node_type == 'code':
-            return self._execute_code(input_dfs, config, context)
-            
-        elif node_type == 'ai_agent':
+        """根据节点类型执行具体逻辑（pandas计算在线程池中执行，同一波次的节点可并行）"""
+        if node_type == 'ai_agent':
             if not input_dfs: return None
             return await self._execute_ai_agent(input_dfs[0], config)
         
-        # ========== 输出 ==========
-        elif node_type in ['output', 'output_csv']:
-            if not input_dfs: return None
-            return input_dfs[0]
+        kernel = _PROCESS_KERNELS.get(node_type)
+        if kernel and len(input_dfs) >= kernel[1] and sum(len(df) for df in input_dfs[:kernel[1]]) >= PROCESS_POOL_MIN_ROWS:
+            method_name, arity = kernel
+            return await asyncio.get_running_loop().run_in_executor(
+                _get_process_pool(), _run_kernel, method_name, input_dfs[:arity], config
+            )
+        return await asyncio.to_thread(self._execute_node_sync, node_type, config, input_dfs, context, file_mapping)
+    
+    def _execute_node_sync(self, node_type: str, config: Dict, input_dfs: List[pd.DataFrame], context: WorkflowContext, file_mapping: Dict) -> Optional[pd.DataFrame]:
+        """执行除AI节点外的同步节点逻辑"""
+        if node_type == 'code':
+            return self._execute_code(input_dfs, config, context)
+        if node_type in ('output', 'output_csv'):
+            return input_dfs[0] if input_dfs else None
         
-        return None
+        handler = _NODE_HANDLERS.get(node_type)
+        if handler is None:
+            return None
+        method_name, arity, error = handler
+        method = getattr(self, method_name)
+        if arity == 0:
+            return method(config, file_mapping)
+        if len(input_dfs) < (arity or 1):
+            if error:
+                raise ValueError(error)
+            return None
+        if arity is None:
+            return method(input_dfs, config)
+        return method(*input_dfs[:arity], config)
 
     # ========== 数据源实现 ==========
     def _execute_source(self, config: Dict, file_mapping: Dict) -> pd.DataFrame:
         file_id = config.get('file_id')
         mapped_id = file_mapping.get(file_id, file_id)
         
-        for f in os.listdir(UPLOAD_DIR):
-            if f.startswith(mapped_id):
-                file_path = os.path.join(UPLOAD_DIR, f)
-                sheet_name = config.get('sheet_name', 0)
-                header_row = config.get('header_row', 1) - 1
-                skip_rows = config.get('skip_rows', 0)
-                
-                try:
-                    sheet_name = int(sheet_name)
-                except:
-                    pass
-                
-                df = pd.read_excel(file_path, sheet_name=sheet_name, header=header_row, skiprows=range(1, skip_rows + 1) if skip_rows else None)
-                return df
-                
-        raise FileNotFoundError(f"找不到文件: {file_id}")
+        file_path = _find_upload(mapped_id)
+        if file_path is None:
+            raise FileNotFoundError(f"找不到文件: {file_id}")
+        
+        sheet_name = config.get('sheet_name', 0)
+        header_row = config.get('header_row', 1) - 1
+        skip_rows = config.get('skip_rows', 0)
+        
+        try:
+            sheet_name = int(sheet_name)
+        except:
+            pass
+        
+        # 默认表头、按名称读取时复用ExcelService的整表缓存（内存+Parquet）
+        if isinstance(sheet_name, str) and header_row == 0 and not skip_rows:
+            return ExcelService.read_sheet_as_dataframe(file_path, sheet_name)
+        
+        df = pd.read_excel(file_path, sheet_name=sheet_name, header=header_row, engine="calamine",
+                           skiprows=range(1, skip_rows + 1) if skip_rows else None)
+        return df
 
     def _execute_source_csv(self, config: Dict, file_mapping: Dict) -> pd.DataFrame:
         file_id = config.get('file_id')
         mapped_id = file_mapping.get(file_id, file_id)
         
-        for f in os.listdir(UPLOAD_DIR):
-            if f.startswith(mapped_id):
-                file_path = os.path.join(UPLOAD_DIR, f)
-                delimiter = config.get('delimiter', ',')
-                encoding = config.get('encoding', 'utf-8')
-                
-                df = pd.read_csv(file_path, delimiter=delimiter, encoding=encoding)
-                return df
-                
-        raise FileNotFoundError(f"找不到文件: {file_id}")
+        file_path = _find_upload(mapped_id)
+        if file_path is None:
+            raise FileNotFoundError(f"找不到文件: {file_id}")
+        
+        delimiter = config.get('delimiter', ',')
+        encoding = config.get('encoding', 'utf-8')
+        
+        # pyarrow只支持单字符分隔符，其余情况及解析失败时由pandas读取
+        if isinstance(delimiter, str) and len(delimiter) == 1:
+            try:
+                return _read_csv_arrow(file_path, delimiter, encoding)
+            except (pa.ArrowInvalid, UnicodeDecodeError, LookupError, ValueError, TypeError) as e:
+                logger.debug(f"pyarrow读取CSV失败，改用pandas: {e}")
+        
+        df = pd.read_csv(file_path, delimiter=delimiter, encoding=encoding)
+        return df
 
     # ========== 数据清洗实现 ==========
     def _execute_transform(self, df: pd.DataFrame, config: Dict) -> pd.DataFrame:
-        df = df.copy()
+        # 各处理只整列替换或新增列（不原地写入列数据），浅拷贝即可避免影响上游节点的结果
+        df = df.copy(deep=False)
         
         # 筛选
         filter_expr = config.get('filter_code')
@@ -327,7 +633,7 @@ class WorkflowEngine:
         return df
 
     def _execute_type_convert(self, df: pd.DataFrame, config: Dict) -> pd.DataFrame:
-        df = df.copy()
+        df = df.copy(deep=False)
         conversions = config.get('conversions', [])
         
         for conv in conversions:
@@ -350,7 +656,7 @@ class WorkflowEngine:
         return df
 
     def _execute_fill_na(self, df: pd.DataFrame, config: Dict) -> pd.DataFrame:
-        df = df.copy()
+        df = df.copy(deep=False)
         strategy = config.get('strategy', 'drop')
         columns = config.get('columns', [])
         fill_value = config.get('fill_value')
@@ -365,14 +671,20 @@ class WorkflowEngine:
             df[target_cols] = df[target_cols].ffill()
         elif strategy == 'bfill':
             df[target_cols] = df[target_cols].bfill()
-        elif strategy == 'mean':
-            for col in target_cols:
-                if df[col].dtype in ['int64', 'float64']:
-                    df[col] = df[col].fillna(df[col].mean())
-        elif strategy == 'median':
-            for col in target_cols:
-                if df[col].dtype in ['int64', 'float64']:
-                    df[col] = df[col].fillna(df[col].median())
+        elif strategy in ('mean', 'median'):
+            # 所有数值列（含float32、可空类型）一次性计算统计量并填充
+            num_cols = df[target_cols].select_dtypes(include='number').columns
+            if len(num_cols):
+                nums = df[num_cols]
+                # 可空整数列的均值/中位数可能是小数，先转为可空浮点
+                nullable_ints = {
+                    c: 'Float64' for c, dt in nums.dtypes.items()
+                    if pd.api.types.is_extension_array_dtype(dt) and pd.api.types.is_integer_dtype(dt)
+                }
+                if nullable_ints:
+                    nums = nums.astype(nullable_ints)
+                stats = nums.mean() if strategy == 'mean' else nums.median()
+                df[num_cols] = nums.fillna(stats)
         
         return df
 
@@ -386,7 +698,7 @@ class WorkflowEngine:
         return df.drop_duplicates(subset=subset if subset else None, keep=keep)
 
     def _execute_text_process(self, df: pd.DataFrame, config: Dict) -> pd.DataFrame:
-        df = df.copy()
+        df = df.copy(deep=False)
         col = config.get('column')
         operation = config.get('operation')
         pattern = config.get('pattern', '')
@@ -409,7 +721,7 @@ class WorkflowEngine:
         return df
 
     def _execute_date_process(self, df: pd.DataFrame, config: Dict) -> pd.DataFrame:
-        df = df.copy()
+        df = df.copy(deep=False)
         col = config.get('column')
         extracts = config.get('extract', [])
         offset = config.get('offset', '')
@@ -417,23 +729,17 @@ class WorkflowEngine:
         if not col or col not in df.columns:
             return df
         
-        df[col] = pd.to_datetime(df[col], errors='coerce')
+        series = pd.to_datetime(df[col], errors='coerce')
+        df[col] = series
         
-        for ext in extracts:
-            if ext == 'year':
-                df[f'{col}_年'] = df[col].dt.year
-            elif ext == 'month':
-                df[f'{col}_月'] = df[col].dt.month
-            elif ext == 'day':
-                df[f'{col}_日'] = df[col].dt.day
-            elif ext == 'weekday':
-                df[f'{col}_周几'] = df[col].dt.dayofweek + 1
-            elif ext == 'quarter':
-                df[f'{col}_季度'] = df[col].dt.quarter
+        # 一次性追加所有提取列
+        new_cols = dict(_DT_EXTRACTS[ext](series, col) for ext in extracts if ext in _DT_EXTRACTS)
+        if new_cols:
+            df = df.assign(**new_cols)
         
         # 日期偏移
         if offset:
-            match = re.match(r'([+-]?\d+)([dMy])', offset)
+            match = _OFFSET_RE.match(offset)
             if match:
                 num, unit = int(match.group(1)), match.group(2)
                 if unit == 'd':
@@ -519,24 +825,25 @@ class WorkflowEngine:
         if isinstance(right_on, str):
             right_on = [right_on]
             
-        # 复制数据并转换类型，避免int vs string匹配失败
-        df1 = df1.copy()
-        df2 = df2.copy()
+        # 浅拷贝后对齐关联键类型（整列替换），避免int vs string匹配失败
+        df1 = df1.copy(deep=False)
+        df2 = df2.copy(deep=False)
         
-        # 验证列存在并转换类型
+        # 验证列存在
         for col in left_on:
             if col not in df1.columns:
                 raise ValueError(f"Join失败: 左表中找不到关联列 '{col}'。现有列: {list(df1.columns)}")
-            df1[col] = df1[col].astype(str)
         
         for col in right_on:
             if col not in df2.columns:
                 raise ValueError(f"Join失败: 右表中找不到关联列 '{col}'。现有列: {list(df2.columns)}")
-            df2[col] = df2[col].astype(str)
+        
+        _align_key_dtypes(df1, df2, left_on, right_on)
         
         logger.info(f"[Join] 模式: {how}, 左表[{left_on}] <-> 右表[{right_on}]")
         
         result = pd.merge(df1, df2, left_on=left_on, right_on=right_on, how=how)
+        result = _restore_key_dtypes(result, left_on + right_on)
         
         # 如果左右键名不同，删除右表的冗余键列
         for l, r in zip(left_on, right_on):
@@ -550,6 +857,10 @@ class WorkflowEngine:
         join = config.get('join', 'outer')
         ignore_index = config.get('ignore_index', True)
         
+        # 只有一个输入时无需拼接，直接复用（下游节点修改前会自行复制）
+        if len(dfs) == 1:
+            return dfs[0].reset_index(drop=True) if ignore_index else dfs[0]
+        
         return pd.concat(dfs, join=join, ignore_index=ignore_index)
 
     def _execute_vlookup(self, main_df: pd.DataFrame, lookup_df: pd.DataFrame, config: Dict) -> pd.DataFrame:
@@ -572,9 +883,9 @@ class WorkflowEngine:
         if not right_key:
             raise ValueError("VLOOKUP必须指定查找表关联列 (right_key 或 lookup_key)")
         
-        # 复制数据避免修改原始数据
-        main_df = main_df.copy()
-        lookup_df = lookup_df.copy()
+        # 浅拷贝避免修改原始数据（关联键对齐只整列替换，不复制列数据）
+        main_df = main_df.copy(deep=False)
+        lookup_df = lookup_df.copy(deep=False)
         
         # 验证列存在
         if left_key not in main_df.columns:
@@ -582,9 +893,8 @@ class WorkflowEngine:
         if right_key not in lookup_df.columns:
             raise ValueError(f"VLOOKUP失败: 查找表中找不到关联列 '{right_key}'。现有列: {list(lookup_df.columns)}")
 
-        # 统一关联键的类型为字符串，避免int64和object类型不匹配
-        main_df[left_key] = main_df[left_key].astype(str)
-        lookup_df[right_key] = lookup_df[right_key].astype(str)
+        # 对齐关联键的类型，避免int64和object类型不匹配
+        _align_key_dtypes(main_df, lookup_df, [left_key], [right_key])
         logger.debug(f"[VLOOKUP] 关联: 主表[{left_key}] <- 查找表[{right_key}]")
         
         # 过滤掉查找表中不存在的返回列
@@ -609,6 +919,7 @@ class WorkflowEngine:
             right_on=right_key, 
             how='left'
         )
+        result = _restore_key_dtypes(result, [left_key, right_key])
         
         # 如果左右键名不同，删除右表的冗余键列
         if left_key != right_key and right_key in result.columns:
@@ -623,14 +934,19 @@ class WorkflowEngine:
         if not compare_columns:
             compare_columns = list(set(df1.columns) & set(df2.columns))
         
-        df1_keys = df1[compare_columns].apply(lambda x: tuple(x), axis=1)
-        df2_keys = df2[compare_columns].apply(lambda x: tuple(x), axis=1)
-        
-        only_in_df1 = df1[~df1_keys.isin(df2_keys)].copy()
-        only_in_df1['_diff_status'] = '仅在表1'
+        # 向量化的键成员判断：单列直接isin，多列用MultiIndex哈希匹配，不再逐行构造元组
+        if len(compare_columns) == 1:
+            col = compare_columns[0]
+            mask1 = ~df1[col].isin(df2[col])
+            mask2 = ~df2[col].isin(df1[col])
+        else:
+            df1_keys = pd.MultiIndex.from_frame(df1[compare_columns])
+            df2_keys = pd.MultiIndex.from_frame(df2[compare_columns])
+            mask1 = ~df1_keys.isin(df2_keys)
+            mask2 = ~df2_keys.isin(df1_keys)
         
-        only_in_df2 = df2[~df2_keys.isin(df1_keys)].copy()
-        only_in_df2['_diff_status'] = '仅在表2'
+        only_in_df1 = df1.loc[mask1].assign(_diff_status='仅在表1')
+        only_in_df2 = df2.loc[mask2].assign(_diff_status='仅在表2')
         
         return pd.concat([only_in_df1, only_in_df2], ignore_index=True)
 
@@ -687,20 +1003,18 @@ class WorkflowEngine:
         if right_column not in summary_df.columns:
             raise ValueError(f"对账失败: 汇总表中找不到金额列 '{right_column}'。现有列: {list(summary_df.columns)}")
         
-        # 1. 对明细表分组汇总
-        detail_grouped = detail_df.groupby(join_keys)[left_column].sum().reset_index()
+        # 1. 对明细表分组汇总（不排序：最终的outer merge会按键排序；observed=True避免类别型键产生未出现的组合）
+        detail_grouped = detail_df.groupby(join_keys, observed=True, sort=False, as_index=False)[left_column].sum()
         detail_grouped = detail_grouped.rename(columns={left_column: '明细汇总金额'})
         logger.debug(f"[Reconcile] 明细汇总后: {len(detail_grouped)} 行")
         
         # 2. 准备汇总表（只取关联键+金额列）
         summary_cols = join_keys + [right_column]
-        summary_renamed = summary_df[summary_cols].copy()
+        summary_renamed = summary_df[summary_cols]
         summary_renamed = summary_renamed.rename(columns={right_column: '汇总表金额'})
         
-        # 3. 统一关联键类型为字符串
-        for key in join_keys:
-            detail_grouped[key] = detail_grouped[key].astype(str)
-            summary_renamed[key] = summary_renamed[key].astype(str)
+        # 3. 对齐关联键类型
+        _align_key_dtypes(detail_grouped, summary_renamed, join_keys, join_keys)
         
         # 4. 合并对比
         merged = pd.merge(
@@ -709,6 +1023,7 @@ class WorkflowEngine:
             on=join_keys, 
             how='outer'
         )
+        merged = _restore_key_dtypes(merged, join_keys)
         
         # 5. 计算差异
         merged['明细汇总金额'] = merged['明细汇总金额'].fillna(0)
@@ -716,21 +1031,20 @@ class WorkflowEngine:
         merged['差额'] = merged['明细汇总金额'] - merged['汇总表金额']
         merged['差额绝对值'] = merged['差额'].abs()
         
-        # 6. 根据容差判断是否一致
-        merged['核算结果'] = merged['差额绝对值'].apply(
-            lambda x: '✅ 一致' if x <= tolerance else '❌ 不一致'
-        )
+        # 6. 根据容差判断是否一致（向量化比较，代替逐行apply）
+        consistent = merged['差额绝对值'].to_numpy(dtype=float, na_value=np.nan) <= tolerance
+        merged['核算结果'] = np.where(consistent, '✅ 一致', '❌ 不一致')
         
         # 7. 根据输出模式过滤
         if output_mode == 'diff_only':
-            result = merged[merged['差额绝对值'] > tolerance].copy()
+            result = merged[merged['差额绝对值'] > tolerance]
         else:
-            result = merged.copy()
+            result = merged
         
         # 清理临时列
         result = result.drop(columns=['差额绝对值'])
         
-        diff_count = len(result[result['核算结果'] == '❌ 不一致']) if '核算结果' in result.columns else 0
+        diff_count = int((result['核算结果'] == '❌ 不一致').sum())
         logger.info(f"[Reconcile] 完成: 明细{len(detail_df)}行 vs 汇总{len(summary_df)}行, 发现差异{diff_count}条")
         
         return result
@@ -741,14 +1055,17 @@ class WorkflowEngine:
         if not code:
             raise ValueError("代码节点内容为空")
             
+        # 用户代码常原地修改df（df.loc[...] = ...、inplace=True），传入深拷贝，避免改动上游结果和结果缓存
+        inputs = [d.copy() for d in input_dfs]
         local_scope = {
-            "inputs": input_dfs,
-            "df": input_dfs[0] if input_dfs else None, 
+            "inputs": inputs,
+            "df": inputs[0] if inputs else None, 
             "pd": pd,
             "result": None
         }
         
-        exec(code, {}, local_scope)
+        code_obj = _compile_user_code(code)
+        exec(code_obj, {'pd': pd, 'np': np}, local_scope)
         result = local_scope.get('result')
         if not isinstance(result, pd.DataFrame):
             raise ValueError("代码节点必须将结果DataFrame赋值给 'result' 变量")
@@ -770,77 +1087,102 @@ class WorkflowEngine:
             raise ValueError("AI节点必须包含Prompt配置")
 
         limit = min(len(df), 20)
-        df_head = df.head(limit).copy()
-        logger.info(f"[AI Agent] 将处理 {limit} 行数据")
-        
-        results = []
-        for idx, (index, row) in enumerate(df_head.iterrows()):
-            logger.info(f"[AI Agent] 处理第 {idx+1}/{limit} 行...")
-            
-            # 构建包含行数据的Prompt
-            row_prompt = prompt_template
-            
-            # 替换模板中的 {{列名}} 占位符
-            for col in df.columns:
-                placeholder = f"{{{{{col}}}}}"
-                if placeholder in row_prompt:
-                    row_prompt = row_prompt.replace(placeholder, str(row[col]))
-            
-            # 如果Prompt中没有任何占位符被替换，自动附加当前行的完整数据
-            has_placeholder = any(f"{{{{{col}}}}}" in prompt_template for col in df.columns)
-            if not has_placeholder:
-                row_data_str = "\n".join([f"- {col}: {row[col]}" for col in df.columns])
-                row_prompt = f"{prompt_template}\n\n当前数据行:\n{row_data_str}"
-            
-            logger.info(f"[AI Agent] 实际Prompt (前300字符): {row_prompt[:300]}...")
-            
-            try:
-                logger.info(f"[AI Agent] 开始调用AI...")
+        df_head = df.head(limit)
+        max_concurrency = max(1, int(config.get('max_concurrency', 8)))
+        logger.info(f"[AI Agent] 将处理 {limit} 行数据，并发数 {max_concurrency}")
+        
+        # 模板中出现的 {{列名}} 占位符只检查一次；逐行只取用到的列，一次正则扫描完成替换
+        # （不用str.format，模板里常有JSON示例等字面量花括号）
+        used_cols = [col for col in df.columns if f"{{{{{col}}}}}" in prompt_template]
+        if used_cols:
+            pattern = re.compile("|".join(re.escape(f"{{{{{col}}}}}") for col in used_cols))
+            prompts = []
+            for values in df_head[used_cols].itertuples(index=False, name=None):
+                mapping = {f"{{{{{col}}}}}": str(v) for col, v in zip(used_cols, values)}
+                prompts.append(pattern.sub(lambda m: mapping[m.group(0)], prompt_template))
+        else:
+            # 如果Prompt中没有任何占位符，自动附加当前行的完整数据
+            columns = list(df.columns)
+            prompts = [
+                f"{prompt_template}\n\n当前数据行:\n" + "\n".join(f"- {col}: {v}" for col, v in zip(columns, values))
+                for values in df_head.itertuples(index=False, name=None)
+            ]
+        
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def process_row(idx: int, row_prompt: str) -> str:
+            logger.debug("[AI Agent] 第 %d 行Prompt (前300字符): %.300s...", idx + 1, row_prompt)
+            async with semaphore:
                 ai_resp = await self._simple_ai_call(row_prompt)
-                logger.info(f"[AI Agent] 第 {idx+1} 行AI返回: {ai_resp[:100] if ai_resp else 'None'}...")
-                results.append(ai_resp)
-            except Exception as e:
-                logger.error(f"[AI Agent] 第 {idx+1} 行调用失败: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                results.append(f"Error: {str(e)}")
+            logger.debug("[AI Agent] 第 %d/%d 行AI返回: %.100s...", idx + 1, limit, ai_resp)
+            return ai_resp
+        
+        # 各行并发调用AI（信号量限制同时在途的请求数），单行失败不影响其他行
+        results = await asyncio.gather(
+            *[process_row(idx, row_prompt) for idx, row_prompt in enumerate(prompts)],
+            return_exceptions=True
+        )
+        for idx, res in enumerate(results):
+            if isinstance(res, Exception):
+                logger.error(f"[AI Agent] 第 {idx+1} 行调用失败: {str(res)}")
+                results[idx] = f"Error: {str(res)}"
         
         logger.info(f"[AI Agent] 所有行处理完成，共 {len(results)} 个结果")
-        df_head[target_column] = results
+        # 结果按行顺序对齐原索引，assign生成新表，不修改输入
+        df_head = df_head.assign(**{target_column: pd.Series(results, index=df_head.index, dtype=object)})
         logger.info(f"[AI Agent] ========== AI Agent 节点执行结束 ==========")
         return df_head
 
     async def _simple_ai_call(self, prompt: str) -> str:
-        import httpx
-        from config import ARK_API_KEY, ARK_BASE_URL, ARK_MODEL_NAME
-        
-        logger.info(f"[AI Agent] 调用AI，使用模型: {ARK_MODEL_NAME}")
-        logger.debug(f"[AI Agent] Prompt: {prompt[:100]}...")
-        
-        try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                resp = await client.post(
-                    f"{ARK_BASE_URL}/chat/completions",
-                    headers={"Authorization": f"Bearer {ARK_API_KEY}"},
-                    json={
-                        "model": ARK_MODEL_NAME,
-                        "messages": [{"role": "user", "content": prompt}]
-                    }
-                )
+        # 以下为逐行日志，用DEBUG级别和惰性格式化，未开启DEBUG时不产生格式化开销
+        logger.debug("[AI Agent] 调用AI，使用模型: %s, Prompt: %.100s...", ARK_MODEL_NAME, prompt)
+        
+        # 请求体用orjson序列化一次，重试时直接复用
+        payload = orjson.dumps({
+            "model": ARK_MODEL_NAME,
+            "messages": [{"role": "user", "content": prompt}]
+        })
+        error_msg = None
+        for attempt in range(AI_MAX_ATTEMPTS):
+            retry_after = None
+            try:
+                async with _ai_limiter:
+                    resp = await self._http.post(
+                        "/chat/completions",
+                        content=payload
+                    )
                 
-                logger.info(f"[AI Agent] API响应状态: {resp.status_code}")
+                logger.debug("[AI Agent] API响应状态: %d", resp.status_code)
                 
                 if resp.status_code == 200:
-                    result = resp.json()['choices'][0]['message']['content']
-                    logger.info(f"[AI Agent] 成功获取响应: {result[:50]}...")
+                    _ai_limiter.on_success()
+                    result = orjson.loads(resp.content)['choices'][0]['message']['content']
+                    logger.debug("[AI Agent] 成功获取响应: %.50s...", result)
                     return result
-                else:
-                    error_msg = f"AI调用失败: HTTP {resp.status_code} - {resp.text[:200]}"
+                
+                error_msg = f"AI调用失败: HTTP {resp.status_code} - {resp.text[:200]}"
+                if resp.status_code not in AI_RETRY_STATUS:
                     logger.error(f"[AI Agent] {error_msg}")
                     return error_msg
-        except Exception as e:
-            logger.error(f"[AI Agent] 调用异常: {str(e)}")
-            return f"调用失败: {str(e)}"
+                retry_after = _retry_after(resp.headers)
+                # 被限流时下调全局并发并按retry-after暂停放行
+                if resp.status_code == 429:
+                    _ai_limiter.on_throttle(retry_after)
+            except httpx.TransportError as e:
+                # 连接失败、超时等网络错误可重试
+                error_msg = f"调用失败: {str(e)}"
+            except Exception as e:
+                logger.error(f"[AI Agent] 调用异常: {str(e)}")
+                return f"调用失败: {str(e)}"
+            
+            if attempt + 1 < AI_MAX_ATTEMPTS:
+                # 指数退避加随机抖动，服务端给出retry-after时以其为准
+                delay = retry_after if retry_after is not None else min(2 ** attempt, 30) + random.random()
+                logger.warning(f"[AI Agent] 第 {attempt+1} 次调用失败，{delay:.1f} 秒后重试: {error_msg}")
+                await asyncio.sleep(delay)
+        
+        logger.error(f"[AI Agent] 重试 {AI_MAX_ATTEMPTS} 次后仍失败: {error_msg}")
+        return error_msg
 
     # ========== 输出实现 ==========
     def _save_output(self, df: pd.DataFrame, config: Dict, node_type: str = 'output') -> str:
@@ -851,68 +1193,119 @@ class WorkflowEngine:
                 filename += '.csv'
             output_path = os.path.join(UPLOAD_DIR, filename)
             encoding = config.get('encoding', 'utf-8')
-            df.to_csv(output_path, index=False, encoding=encoding)
+            ExcelService.export_csv(df, output_path, encoding)
         else:
-            if not filename.endswith('.xlsx'):
-                filename += '.xlsx'
+            # 指定parquet格式，或超出Excel单表行数上限时，写为Parquet（列式压缩，写入快得多）
+            if config.get('format') == 'parquet' or len(df) >= EXCEL_MAX_ROWS:
+                if len(df) >= EXCEL_MAX_ROWS:
+                    logger.warning(f"输出数据共 {len(df)} 行，超出Excel上限，改为导出Parquet文件")
+                filename = os.path.splitext(filename)[0] if filename.endswith('.xlsx') else filename
+                suffix = '.parquet'
+            else:
+                suffix = '.xlsx'
+            if not filename.endswith(suffix):
+                filename += suffix
             output_path = os.path.join(UPLOAD_DIR, filename)
-            df.to_excel(output_path, index=False)
+            ExcelService.export_dataframe(df, output_path)
         
         return str(filename)
 
     # ========== 数据库操作方法 ==========
     async def get_all_workflows(self) -> List[Dict]:
-        import aiosqlite
-        from database import DATABASE_PATH
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with get_connection() as db:
             cursor = await db.execute("SELECT id, name, description, created_at, updated_at FROM workflows ORDER BY updated_at DESC")
             rows = await cursor.fetchall()
             return [dict(row) for row in rows]
     
     async def get_workflow(self, workflow_id: str) -> Optional[Dict]:
-        import aiosqlite
-        from database import DATABASE_PATH
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("SELECT * FROM workflows WHERE id = ?", (workflow_id,))
+        async with get_connection() as db:
+            cursor = await db.execute(
+                "SELECT id, name, description, fingerprint, created_at, updated_at FROM workflows WHERE id = ?",
+                (workflow_id,)
+            )
             row = await cursor.fetchone()
-            if row:
-                result = dict(row)
-                result['config'] = json.loads(result['config'])
+            if not row:
+                return None
+            result = dict(row)
+            
+            # 配置未修改时复用已解析的结果，不再读取和解析config
+            cached = _config_cache.get(workflow_id)
+            if cached is not None and cached[0] == result['updated_at']:
+                result['config'] = cached[1]
                 return result
+            
+            cursor = await db.execute("SELECT config FROM workflows WHERE id = ?", (workflow_id,))
+            config_row = await cursor.fetchone()
+        if not config_row:
             return None
+        result['config'] = orjson.loads(config_row[0])
+        _config_cache[workflow_id] = (result['updated_at'], result['config'])
+        return result
     
-    async def save_workflow(self, workflow_id: str, name: str, description: str, config: Dict):
-        import aiosqlite
-        from database import DATABASE_PATH
-        async with aiosqlite.connect(DATABASE_PATH) as db:
+    async def save_workflow(self, workflow_id: str, name: str, description: str, config: Dict,
+                            dedupe: bool = False) -> str:
+        """
+        保存工作流，返回实际的工作流ID
+        
+        dedupe为True（新建工作流）时，若已有配置指纹相同的工作流，则更新其名称和描述，不再新增记录
+        """
+        # 序列化在借出连接之前完成，缩短占用连接的时间
+        config_json = orjson.dumps(config).decode()
+        config_fingerprint = fingerprint(config)
+        async with get_connection() as db:
+            if dedupe:
+                cursor = await db.execute(
+                    "SELECT id FROM workflows WHERE fingerprint = ? LIMIT 1", (config_fingerprint,)
+                )
+                row = await cursor.fetchone()
+                if row:
+                    workflow_id = row[0]
             await db.execute("""
-                INSERT OR REPLACE INTO workflows (id, name, description, config, updated_at)
-                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-            """, (workflow_id, name, description, json.dumps(config, ensure_ascii=False)))
+                INSERT INTO workflows (id, name, description, config, fingerprint, updated_at)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(id) DO UPDATE SET
+                    name = excluded.name,
+                    description = excluded.description,
+                    config = excluded.config,
+                    fingerprint = excluded.fingerprint,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (workflow_id, name, description, config_json, config_fingerprint))
             await db.commit()
+        # updated_at精度为秒，同一秒内的多次修改需显式失效
+        _config_cache.pop(workflow_id, None)
+        return workflow_id
     
     async def save_execution_history(self, workflow_id: str, input_files: List, output_file: str, status: str, result_summary: str) -> str:
-        import aiosqlite
-        from database import DATABASE_PATH
         history_id = str(uuid4())
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            await db.execute("""
-                INSERT INTO execution_history (id, workflow_id, input_files, output_file, status, result_summary)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (history_id, workflow_id, json.dumps(input_files), output_file, status, result_summary))
-            await db.commit()
+        await self.record_history_batch([
+            (history_id, workflow_id, orjson.dumps(input_files).decode(), output_file, status, result_summary, None)
+        ])
         return history_id
     
+    async def record_history_batch(self, rows: List[tuple]) -> List[str]:
+        """
+        批量写入执行历史，一次事务只提交一次，返回写入的记录ID
+        
+        每行为(id, workflow_id, input_files, output_file, status, result_summary, node_details)
+        """
+        if not rows:
+            return []
+        async with get_connection() as db:
+            await db.executemany("""
+                INSERT INTO execution_history (id, workflow_id, input_files, output_file, status, result_summary, node_details)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            await db.commit()
+        return [row[0] for row in rows]
+    
     async def get_execution_history(self, limit: int = 50) -> List[Dict]:
-        import aiosqlite
-        from database import DATABASE_PATH
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with get_connection() as db:
             cursor = await db.execute("SELECT * FROM execution_history ORDER BY created_at DESC LIMIT ?", (limit,))
             rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+        history = [dict(row) for row in rows]
+        for item in history:
+            item['node_details'] = orjson.loads(item['node_details']) if item.get('node_details') else []
+        return history
 
 # 单例
 workflow_engine = WorkflowEngine()
@@ -0,0 +1,222 @@
+"""
+xlsx快速预览 - 直接读取ZIP内的工作表XML，只解析表头和前几行
+
+行数取自<dimension>标签，读取量与表大小无关；
+遇到无法确定结构的文件返回None，由调用方回退到calamine完整解析。
+"""
+import asyncio
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_NS_PKG = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+_CELL_REF_RE = re.compile(r"([A-Z]+)(\d+)$")
+_RANGE_RE = re.compile(r"A1:([A-Z]+)(\d+)$")
+# 内置日期/时间格式ID
+_DATE_FMT_IDS = frozenset(range(14, 23)) | {45, 46, 47}
+# 自定义格式去掉引号文本、[颜色]等方括号段和转义字符后，含日期时间占位符即视为日期格式
+_FMT_LITERAL_RE = re.compile(r'"[^"]*"|\[[^\]]*\]|\\.')
+_DATE_TOKEN_RE = re.compile(r"[dmyhs]", re.IGNORECASE)
+_EXCEL_EPOCH = datetime(1899, 12, 30)
+
+
+def _col_index(letters: str) -> int:
+    index = 0
+    for ch in letters:
+        index = index * 26 + ord(ch) - 64
+    return index - 1
+
+
+def _sheet_paths(zf: zipfile.ZipFile) -> Optional[List[Tuple[str, str]]]:
+    """按工作簿顺序返回[(sheet名, 工作表XML路径)]"""
+    rels = ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    targets = {}
+    for rel in rels.iter(f"{_NS_PKG}Relationship"):
+        target = rel.get("Target", "")
+        targets[rel.get("Id")] = target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+
+    workbook = ET.fromstring(zf.read("xl/workbook.xml"))
+    sheets = []
+    for sheet in workbook.iter(f"{_NS}sheet"):
+        path = targets.get(sheet.get(f"{_NS_R}id"))
+        if not path or "/worksheets/" not in path:
+            return None
+        sheets.append((sheet.get("name"), path))
+    return sheets
+
+
+def _date_style_ids(zf: zipfile.ZipFile) -> Set[int]:
+    """返回使用日期格式的单元格样式下标"""
+    try:
+        styles = ET.fromstring(zf.read("xl/styles.xml"))
+    except KeyError:
+        return set()
+
+    custom = {
+        int(fmt.get("numFmtId")): fmt.get("formatCode", "")
+        for fmt in styles.iter(f"{_NS}numFmt")
+    }
+    cell_xfs = styles.find(f"{_NS}cellXfs")
+    if cell_xfs is None:
+        return set()
+
+    date_ids = set()
+    for i, xf in enumerate(cell_xfs.iter(f"{_NS}xf")):
+        fmt_id = int(xf.get("numFmtId", 0))
+        code = custom.get(fmt_id)
+        if code is not None:
+            if _DATE_TOKEN_RE.search(_FMT_LITERAL_RE.sub("", code)):
+                date_ids.add(i)
+        elif fmt_id in _DATE_FMT_IDS:
+            date_ids.add(i)
+    return date_ids
+
+
+def _shared_strings(zf: zipfile.ZipFile, needed: Set[int]) -> Dict[int, str]:
+    """流式读取共享字符串，取到所需的最大下标即停止"""
+    if not needed:
+        return {}
+    last = max(needed)
+    result = {}
+    with zf.open("xl/sharedStrings.xml") as f:
+        index = 0
+        for _, elem in ET.iterparse(f):
+            if elem.tag != f"{_NS}si":
+                continue
+            if index in needed:
+                # 富文本由多个<r><t>组成；<rPh>为注音，不计入
+                parts = [elem.findtext(f"{_NS}t")] if elem.find(f"{_NS}t") is not None else [
+                    r.findtext(f"{_NS}t") for r in elem.iter(f"{_NS}r")
+                ]
+                result[index] = "".join(p or "" for p in parts)
+            elem.clear()
+            if index >= last:
+                break
+            index += 1
+    return result
+
+
+def _to_datetime(serial: float) -> Any:
+    """Excel日期序列号转为date/time/datetime（与calamine一致）"""
+    value = _EXCEL_EPOCH + timedelta(days=serial)
+    if serial < 1:
+        return value.time()
+    if serial.is_integer():
+        return value.date()
+    return value
+
+
+def _read_rows(zf: zipfile.ZipFile, path: str, nrows: int) -> Optional[Tuple[List[list], int, int]]:
+    """读取工作表前nrows行的原始单元格，返回(行列表, 总行数, 列数)"""
+    height = width = None
+    rows: List[list] = []
+    with zf.open(path) as f:
+        next_row = 1
+        for _, elem in ET.iterparse(f):
+            if elem.tag == f"{_NS}dimension":
+                match = _RANGE_RE.match(elem.get("ref", ""))
+                if not match:
+                    return None
+                width = _col_index(match.group(1)) + 1
+                height = int(match.group(2))
+            elif elem.tag == f"{_NS}row":
+                if width is None:
+                    return None
+                row_num = int(elem.get("r", next_row))
+                if row_num > nrows:
+                    break
+                # 缺失的空行补齐
+                while len(rows) < row_num - 1:
+                    rows.append([None] * width)
+                cells = [None] * width
+                col = 0
+                for c in elem.iter(f"{_NS}c"):
+                    ref = c.get("r")
+                    if ref:
+                        match = _CELL_REF_RE.match(ref)
+                        if match:
+                            col = _col_index(match.group(1))
+                    if col < width:
+                        cells[col] = (c.get("t"), c.get("s"), c.findtext(f"{_NS}v"), c.findtext(f".//{_NS}t"))
+                    col += 1
+                rows.append(cells)
+                next_row = row_num + 1
+                elem.clear()
+    if height is None:
+        return None
+    while len(rows) < min(nrows, height):
+        rows.append([None] * width)
+    return rows, height, width
+
+
+def _convert_sheets(zf: zipfile.ZipFile, raw_sheets: List[Tuple[str, List[list], int]]) -> List[Tuple[str, List[List[Any]], int]]:
+    """解析共享字符串、布尔值和日期格式，得到与calamine一致的单元格值"""
+    raw_cells = [cell for _, rows, _ in raw_sheets for row in rows for cell in row if cell]
+    strings = _shared_strings(zf, {int(v) for t, _, v, _ in raw_cells if t == "s" and v is not None})
+    date_styles = _date_style_ids(zf) if any(s for t, s, _, _ in raw_cells if t in (None, "n")) else set()
+
+    def convert(cell):
+        if cell is None:
+            return ""
+        cell_type, style, value, text = cell
+        if cell_type == "s":
+            return strings.get(int(value), "") if value is not None else ""
+        if cell_type == "inlineStr":
+            return text or ""
+        if value is None:
+            return ""
+        if cell_type == "b":
+            return value == "1"
+        if cell_type in ("str", "e"):
+            return value
+        number = float(value)
+        if style is not None and int(style) in date_styles:
+            return _to_datetime(number)
+        return number
+
+    return [(name, [[convert(c) for c in row] for row in rows], height) for name, rows, height in raw_sheets]
+
+
+def peek_xlsx(file_path: str, nrows: int = 6) -> Optional[List[Tuple[str, List[List[Any]], int]]]:
+    """
+    读取每个Sheet的前nrows行（单元格值与calamine的to_python一致，空单元格为""）
+
+    Returns:
+        [(sheet名, 行列表, 总行数), ...]；结构无法识别时返回None
+    """
+    with zipfile.ZipFile(file_path) as zf:
+        sheet_paths = _sheet_paths(zf)
+        if sheet_paths is None:
+            return None
+
+        raw_sheets = []
+        for name, path in sheet_paths:
+            parsed = _read_rows(zf, path, nrows)
+            if parsed is None:
+                return None
+            raw_sheets.append((name, parsed[0], parsed[1]))
+        return _convert_sheets(zf, raw_sheets)
+
+
+async def peek_xlsx_async(file_path: str, nrows: int = 6) -> Optional[List[Tuple[str, List[List[Any]], int]]]:
+    """peek_xlsx的异步版本：共用一个ZipFile句柄，各Sheet在线程中并发解析"""
+    zf = await asyncio.to_thread(zipfile.ZipFile, file_path)
+    try:
+        sheet_paths = await asyncio.to_thread(_sheet_paths, zf)
+        if sheet_paths is None:
+            return None
+
+        parsed = await asyncio.gather(
+            *[asyncio.to_thread(_read_rows, zf, path, nrows) for _, path in sheet_paths]
+        )
+        if any(p is None for p in parsed):
+            return None
+        raw_sheets = [(name, p[0], p[1]) for (name, _), p in zip(sheet_paths, parsed)]
+        return await asyncio.to_thread(_convert_sheets, zf, raw_sheets)
+    finally:
+        zf.close()
@@ -0,0 +1,26 @@
+"""
+Excel服务测试
+"""
+import xlsxwriter
+
+from services import excel_service
+from services.excel_service import ExcelService
+
+
+def test_preview_sheet_duplicate_headers_match_dataframe_columns(tmp_path, monkeypatch):
+    """重名、空表头的列都保留在预览中，列名与数据源节点读出的一致"""
+    monkeypatch.setattr(excel_service, "SHEET_CACHE_DIR", str(tmp_path))
+    path = str(tmp_path / "dup.xlsx")
+    workbook = xlsxwriter.Workbook(path)
+    sheet = workbook.add_worksheet("Sheet1")
+    sheet.write_row(0, 0, ["金额", "金额", None, "名称"])
+    sheet.write_row(1, 0, [1, 2, "a", "苹果"])
+    sheet.write_row(2, 0, [3, 4, "b", "香蕉"])
+    workbook.close()
+    
+    preview = ExcelService.preview_sheet(path, "Sheet1", rows=10)
+    
+    assert preview["columns"] == ["金额", "金额.1", "Unnamed: 2", "名称"]
+    assert preview["columns"] == ExcelService.read_sheet_as_dataframe(path, "Sheet1").columns.tolist()
+    assert preview["data"] == [[1, 3], [2, 4], ["a", "b"], ["苹果", "香蕉"]]
+    assert preview["total_rows"] == 2
@@ -0,0 +1,23 @@
+"""
+工具函数测试
+"""
+import asyncio
+
+from utils import AdaptiveLimiter
+
+
+def test_limiter_releases_slot_when_cancelled_during_backoff():
+    """限流暂停期间被取消时归还并发名额"""
+    async def scenario():
+        limiter = AdaptiveLimiter(2)
+        limiter.on_throttle(retry_after=5)
+        task = asyncio.create_task(limiter.__aenter__())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return limiter._in_flight
+    
+    assert asyncio.run(scenario()) == 0
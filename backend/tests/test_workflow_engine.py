@@ -0,0 +1,86 @@
+"""
+工作流引擎节点测试
+"""
+import asyncio
+
+import pandas as pd
+import pytest
+from cachetools import LRUCache
+
+from services import workflow_engine
+from services.workflow_engine import WorkflowContext, WorkflowEngine, _estimate_nbytes, _read_csv_arrow
+
+
+@pytest.fixture
+def engine():
+    return WorkflowEngine()
+
+
+def test_fill_na_numeric_value_on_text_column(engine, tmp_path):
+    """数据源读出的文本列可以用数值填充缺失值"""
+    path = tmp_path / "data.csv"
+    path.write_text("名称,金额\n苹果,1\n,2\n香蕉,\n", encoding="utf-8")
+    df = _read_csv_arrow(str(path), ",", "utf-8")
+    
+    result = engine._execute_fill_na(df, {"strategy": "fill_value", "fill_value": 0})
+    
+    assert result["名称"].tolist() == ["苹果", 0, "香蕉"]
+    assert result["金额"].tolist() == [1, 2, 0]
+    # 上游结果不受影响
+    assert df["名称"].isna().sum() == 1
+
+
+def test_oversized_result_skips_node_cache(engine, monkeypatch):
+    """结果超过缓存容量时跳过缓存，节点仍正常返回"""
+    monkeypatch.setattr(workflow_engine, "_node_cache", LRUCache(maxsize=1, getsizeof=_estimate_nbytes))
+    context = WorkflowContext()
+    context.set_result("src", pd.DataFrame({"a": ["x", "y"]}), cache_key="src-key")
+    node = {"id": "t", "data": {"type": "transform", "config": {}}}
+    
+    result_df, _, cache_key = asyncio.run(engine._run_node(node, ["src"], context, {}))
+    
+    assert result_df["a"].tolist() == ["x", "y"]
+    assert cache_key is not None
+    assert cache_key not in workflow_engine._node_cache
+
+
+def test_read_csv_arrow_keeps_dates_as_text(tmp_path):
+    """ISO日期列与pd.read_csv一致保持为字符串"""
+    path = tmp_path / "dates.csv"
+    path.write_text("日期,时间,金额\n2024-01-01,2024-01-01 08:00:00,1\n2024-01-02,,2\n", encoding="utf-8")
+    
+    df = _read_csv_arrow(str(path), ",", "utf-8")
+    expected = pd.read_csv(path)
+    
+    assert df["日期"].tolist() == expected["日期"].tolist()
+    assert df["时间"].tolist()[0] == "2024-01-01 08:00:00"
+    assert df.dtypes.tolist() == expected.dtypes.tolist()
+
+
+def test_source_csv_multichar_delimiter_falls_back_to_pandas(engine, tmp_path, monkeypatch):
+    """多字符分隔符不支持pyarrow读取，回退到pandas"""
+    path = tmp_path / "multi.csv"
+    path.write_text("名称;;日期\n苹果;;2024-01-01\n香蕉;;2024-01-02\n", encoding="utf-8")
+    monkeypatch.setattr(workflow_engine, "_find_upload", lambda mapped_id: str(path))
+    
+    df = engine._execute_source_csv({"file_id": "f", "delimiter": ";;"}, {})
+    
+    assert df.columns.tolist() == ["名称", "日期"]
+    assert df["日期"].tolist() == ["2024-01-01", "2024-01-02"]
+
+
+def test_code_node_inplace_edits_apply_without_touching_inputs(engine):
+    """代码节点中的原地修改对df生效，且不影响上游结果"""
+    upstream = pd.DataFrame({"a": [1.0, None], "b": ["x", "y"]})
+    code = (
+        "df.fillna({'a': 0}, inplace=True)\n"
+        "df.loc[df['b'] == 'y', 'b'] = 'z'\n"
+        "result = df"
+    )
+    
+    result = engine._execute_code([upstream], {"python_code": code}, WorkflowContext())
+    
+    assert result["a"].tolist() == [1.0, 0.0]
+    assert result["b"].tolist() == ["x", "z"]
+    assert upstream["a"].isna().sum() == 1
+    assert upstream["b"].tolist() == ["x", "y"]
@@ -0,0 +1,131 @@
+"""
+通用工具函数
+"""
+import asyncio
+import hashlib
+import json
+import re
+import time
+import orjson
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+# 进行中的调用：key -> 共享的Future
+_inflight: Dict[str, asyncio.Future] = {}
+
+# AI回复中的代码块（按优先级：```json块、普通```块）
+_FENCED_JSON_PATTERNS = (
+    re.compile(r'```json\s*([\s\S]*?)\s*```'),
+    re.compile(r'```\s*([\s\S]*?)\s*```'),
+)
+
+
+def fingerprint(obj: Any) -> str:
+    """计算对象的稳定指纹（键排序后的JSON做blake2b摘要），用于去重和缓存键"""
+    payload = json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def extract_json(text: str) -> Any:
+    """
+    从AI回复中提取JSON：先整体解析，再取```json/```代码块，
+    最后截取第一个'{'到最后一个'}'之间的内容
+    """
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    
+    # 代码块优先于花括号截取：说明文字里出现的'{'会让截取从错误的位置开始
+    for pattern in _FENCED_JSON_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            try:
+                return orjson.loads(match.group(1))
+            except orjson.JSONDecodeError:
+                continue
+    
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        try:
+            return orjson.loads(text[start:end + 1])
+        except orjson.JSONDecodeError:
+            pass
+    raise ValueError("无法解析AI返回的JSON")
+
+
+async def singleflight(key: str, func: Callable[[], Awaitable[T]]) -> T:
+    """同一key的并发调用只执行一次func，其余调用方等待并共享结果（或异常）"""
+    future = _inflight.get(key)
+    if future is not None:
+        return await asyncio.shield(future)
+    
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        result = await func()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # 标记为已取回，避免无等待者时告警
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        _inflight.pop(key, None)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD自适应并发限制
+    被限流时并发上限减半并暂停retry_after秒；持续成功时每隔increase_interval秒上限加1
+    """
+    
+    def __init__(self, maximum: int, minimum: int = 2, increase_interval: float = 10.0):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.limit = maximum
+        self.increase_interval = increase_interval
+        self._in_flight = 0
+        self._cond = asyncio.Condition()
+        self._resume_at = 0.0
+        self._last_change = time.monotonic()
+    
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                # 暂停期间被取消时不会执行__aexit__，需在此归还名额
+                await self.__aexit__()
+                raise
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        async with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+        return False
+    
+    def on_success(self):
+        """请求成功：距上次调整超过间隔时上限加1"""
+        now = time.monotonic()
+        if self.limit < self.maximum and now - self._last_change >= self.increase_interval:
+            self.limit += 1
+            self._last_change = now
+    
+    def on_throttle(self, retry_after: Optional[float] = None):
+        """被限流或配额将尽：上限减半，并在retry_after秒内暂停放行"""
+        now = time.monotonic()
+        self.limit = max(self.minimum, self.limit // 2)
+        self._last_change = now
+        if retry_after:
+            self._resume_at = max(self._resume_at, now + retry_after)
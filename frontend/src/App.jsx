@@ -350,7 +350,12 @@ function FileManager({ files, onUpload, onDelete, onPreview }) {
                 <div style={{ background: 'white', borderRadius: 12, padding: 12, border: '1px solid rgba(0,0,0,0.02)', marginBottom: 12 }}>
                     <Upload.Dragger
                         showUploadList={false}
-                        customRequest={({ file, onSuccess, onError }) => onUpload({ file }).then(onSuccess).catch(onError)}
+                        multiple
+                        // 一次选择/拖入的多个文件在最后一个回调时合并为一次批量上传
+                        beforeUpload={(file, fileList) => {
+                            if (file === fileList[fileList.length - 1]) onUpload(fileList);
+                            return false;
+                        }}
                         style={{ border: '1px dashed #E5E5EA', background: '#F5F5F7', borderRadius: 8, padding: '12px 0' }}
                     >
                         <p className="ant-upload-drag-icon" style={{ marginBottom: 4 }}>
@@ -742,20 +747,28 @@ function App() {
         init();
     }, []);
 
-    const handleUpload = async ({ file }) => {
+    const handleUpload = async (fileList) => {
         setLoading(true);
         try {
-            const result = await excelApi.upload(file);
-            message.success('上传成功');
+            const result = await excelApi.uploadBatch(fileList);
+            const uploaded = result.files.filter(f => !f.error);
+            const failed = result.files.filter(f => f.error);
+            if (failed.length) {
+                message.error(`上传失败: ${failed.map(f => f.filename).join(', ')}`);
+            }
+            if (uploaded.length) {
+                message.success(`上传成功 ${uploaded.length} 个文件`);
+            }
             const data = await excelApi.getFiles();
             setFiles(data.files || []);
-            setSelectedFiles(prev => [...prev, result.file_id]);
+            // 重复上传相同内容时后端返回已有的file_id
+            const ids = uploaded.map(f => f.file_id);
+            setSelectedFiles(prev => [...prev, ...ids.filter((id, i) => !prev.includes(id) && ids.indexOf(id) === i)]);
         } catch (error) {
             message.error('上传失败');
         } finally {
             setLoading(false);
         }
-        return false;
     };
 
     const deleteFile = async (fileId) => {
@@ -1000,14 +1013,22 @@ function App() {
         setChatInput('');
         setChatLoading(true);
 
+        // 先放一条空的AI消息，流式片段到达时逐步追加
+        setChatMessages(prev => [...prev, { role: 'assistant', content: '' }]);
+        const appendToReply = (text, replace = false) => setChatMessages(prev => {
+            const last = prev[prev.length - 1];
+            return [...prev.slice(0, -1), { ...last, content: replace ? text : last.content + text }];
+        });
+
         try {
-            const result = await aiApi.chatMessage(chatSessionId, userMsg);
+            const result = await aiApi.chatMessageStream(chatSessionId, userMsg, appendToReply);
             console.log('[AI-Chat] 收到回复:', result);
 
-            setChatMessages(prev => [...prev, { role: 'assistant', content: result.message }]);
+            appendToReply(result.message, true);
             setChatStatus(result.status);
         } catch (error) {
             console.error('[AI-Chat] 发送消息失败:', error);
+            setChatMessages(prev => prev.slice(0, -1));
             message.error('发送失败: ' + (error.response?.data?.detail || error.message));
         } finally {
             setChatLoading(false);
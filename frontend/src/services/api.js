@@ -8,6 +8,23 @@ const api = axios.create({
     timeout: 300000,
 });
 
+// 列式数据 [[第1列的值...], ...]（与columns按位置对应）转为表格使用的行记录 [{列名: 值}, ...]
+const columnarToRecords = (columns, data) => {
+    const rowCount = data.length ? data[0].length : 0;
+    return Array.from({ length: rowCount }, (_, idx) => {
+        const row = {};
+        columns.forEach((col, i) => { row[col] = data[i][idx]; });
+        return row;
+    });
+};
+
+// 行式数据 columns + [[值...], ...] 转为行记录 [{列名: 值}, ...]
+const rowsToRecords = (columns, rows) => rows.map(values => {
+    const row = {};
+    columns.forEach((col, i) => { row[col] = values[i]; });
+    return row;
+});
+
 // Excel相关API
 export const excelApi = {
     // 上传文件
@@ -20,6 +37,16 @@ export const excelApi = {
         return response.data;
     },
 
+    // 批量上传文件
+    uploadBatch: async (files) => {
+        const formData = new FormData();
+        files.forEach(file => formData.append('files', file));
+        const response = await api.post('/excel/upload/batch', formData, {
+            headers: { 'Content-Type': 'multipart/form-data' }
+        });
+        return response.data;
+    },
+
     // 获取所有文件
     getFiles: async () => {
         const response = await api.get('/excel/files');
@@ -37,7 +64,8 @@ export const excelApi = {
         const response = await api.get(`/excel/file/${fileId}/sheet/${encodeURIComponent(sheetName)}/preview`, {
             params: { rows }
         });
-        return response.data;
+        const { columns, data, total_rows } = response.data;
+        return { columns, data: columnarToRecords(columns, data), total_rows };
     },
 
     // 删除文件
@@ -91,6 +119,45 @@ export const aiApi = {
         return response.data;
     },
 
+    // 发送消息（SSE流式接收回复，onDelta 逐段回调），返回最终结果 {message, status}
+    chatMessageStream: async (sessionId, message, onDelta) => {
+        const response = await fetch('/api/ai/chat/message/stream', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ session_id: sessionId, message })
+        });
+        if (!response.ok) {
+            const detail = await response.json().catch(() => ({}));
+            throw new Error(detail.detail || `HTTP ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let sep;
+            while ((sep = buffer.indexOf('\n\n')) !== -1) {
+                const line = buffer.slice(0, sep);
+                buffer = buffer.slice(sep + 2);
+                if (!line.startsWith('data: ')) continue;
+
+                const event = JSON.parse(line.slice(6));
+                if (event.delta) {
+                    onDelta(event.delta);
+                } else if (event.error) {
+                    throw new Error(event.error);
+                } else if (event.done) {
+                    return event;
+                }
+            }
+        }
+        throw new Error('连接已中断');
+    },
+
     // 确认生成工作流
     chatGenerate: async (sessionId) => {
         console.log('[aiApi] chatGenerate:', sessionId);
@@ -132,7 +199,17 @@ export const workflowApi = {
             workflow_config: workflowConfig,
             file_mapping: fileMapping
         });
-        return response.data;
+        const result = response.data;
+        // 预览数据以split格式返回，转为表格使用的行记录
+        if (result.preview) {
+            result.preview.data = rowsToRecords(result.preview.columns, result.preview.data);
+        }
+        Object.values(result.node_results || {}).forEach(nodeResult => {
+            if (nodeResult.columns) {
+                nodeResult.data = rowsToRecords(nodeResult.columns, nodeResult.data);
+            }
+        });
+        return result;
     },
 
     // 获取历史记录